@@ -7,8 +7,19 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Fan manager.')
     parser.add_argument("--config", "-c", default=None,
                         help="where to look for the config file")
+    parser.add_argument("--autotune", nargs="?", const="-", default=None, metavar="OUTPUT",
+                        help="run step response experiments and write suggested PID constants "
+                             "to OUTPUT (stdout if not given) instead of controlling the fans")
+    parser.add_argument("--calibrate", nargs="?", const="-", default=None, metavar="OUTPUT",
+                        help="measure minimal PWM and PWM to RPM curve of all fans, store them in the "
+                             "state store and write them to OUTPUT (stdout if not given)")
     args = parser.parse_args()
 
-    controler.Controler(args.config).run()
+    if args.autotune is not None:
+        controler.Controler(args.config).run_autotune(None if args.autotune == "-" else args.autotune)
+    elif args.calibrate is not None:
+        controler.Controler(args.config).run_calibration(None if args.calibrate == "-" else args.calibrate)
+    else:
+        controler.Controler(args.config).run()
 else:
     raise Exception("Don't import this file, it's just a runner.")
@@ -0,0 +1,160 @@
+from . import timing
+
+import asyncio
+import concurrent.futures
+import logging
+
+logger = logging.getLogger(__name__)
+
+class _Acquisition:
+    """ Bookkeeping shared by the acquisition implementations.
+
+    All sensor queries of one cycle are started at once and gathered with a deadline,
+    so that a cycle takes about as long as the slowest sensor instead of the sum of all of them.
+    Thermometers that are not due for reading according to their update interval
+    are skipped and their last status is reported. """
+
+    def __init__(self, timings = timing.no_timings):
+        self._timings = timings
+        self._pending = {} # thermometer -> job that didn't finish before the deadline
+        self._accumulated_dt = {} # thermometer -> time since the last started update
+        self._last_status = {} # thermometer -> last status block returned by update
+
+    def _start(self, thermometers, dt, start_job):
+        """ Start jobs for all thermometers that are due, using start_job(thermometer, dt).
+        Returns dict thermometer -> (job, dt) and a set of skipped thermometers. """
+        jobs = {}
+        skipped = set()
+        for thermometer in thermometers:
+            if thermometer in jobs or thermometer in skipped:
+                continue
+
+            due = thermometer.is_due(dt)
+            if thermometer not in self._pending and not due:
+                self._accumulated_dt[thermometer] = self._accumulated_dt.get(thermometer, 0) + dt
+                skipped.add(thermometer)
+                continue
+
+            if dt is None:
+                thermometer_dt = None
+            else:
+                thermometer_dt = self._accumulated_dt.get(thermometer, 0) + dt
+
+            job = self._pending.pop(thermometer, None)
+            if job is None:
+                job = start_job(thermometer, thermometer_dt)
+                self._accumulated_dt[thermometer] = 0
+            else:
+                self._accumulated_dt[thermometer] = thermometer_dt
+
+            jobs[thermometer] = (job, thermometer_dt)
+
+        return jobs, skipped
+
+    def _timed(self, operation, function, thermometer, *args):
+        with self._timings.measure("thermometers", thermometer.name, operation):
+            return function(*args)
+
+    async def _timed_async(self, operation, function, thermometer, *args):
+        with self._timings.measure("thermometers", thermometer.name, operation):
+            return await function(*args)
+
+    def _collect(self, jobs, skipped, deadline, keep_pending):
+        """ Gather results of jobs after the deadline.
+        Unfinished jobs are either kept running (and picked up in a later cycle),
+        or cancelled, based on keep_pending. """
+        ret = {thermometer: self._last_status[thermometer] for thermometer in skipped}
+        for thermometer, (job, thermometer_dt) in jobs.items():
+            error = None
+            if job.done():
+                try:
+                    status = job.result()
+                except Exception as e:
+                    logger.warning("Reading thermometer %s failed (%s)", thermometer.name, e)
+                    error = str(e)
+                else:
+                    thermometer.sampled()
+                    self._last_status[thermometer] = status
+                    ret[thermometer] = status
+                    continue
+            else:
+                logger.warning("Reading thermometer %s didn't finish in %.1fs", thermometer.name, deadline)
+                error = "Deadline missed"
+                if keep_pending:
+                    self._pending[thermometer] = job
+                else:
+                    job.cancel()
+                    if thermometer_dt is not None:
+                        self._accumulated_dt[thermometer] += thermometer_dt
+
+            # Report the last known values, the fan decides whether they are too old to be used
+            status = dict(self._last_status.get(thermometer, {}))
+            status["stale"] = True
+            status["error"] = error
+            ret[thermometer] = status
+
+        return ret
+
+class ParallelAcquisition(_Acquisition):
+    """ Runs thermometer updates concurrently in a thread pool.
+
+    Sensors that miss the deadline keep running in the background and their last known
+    status is reported (marked as stale) until they finish. Sensors should therefore
+    bound their own blocking time (like Harddrive's command_timeout does). """
+
+    def __init__(self, max_workers, timings = timing.no_timings):
+        super().__init__(timings)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                               thread_name_prefix="Sensor")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    def update(self, thermometers, dt, deadline):
+        """ Update all thermometers, waiting at most deadline seconds.
+        Thermometers may repeat in the input, each one is updated only once.
+        Returns dict thermometer -> status block. """
+        jobs, skipped = self._start(thermometers, dt,
+                                    lambda thermometer, dt: self._executor.submit(self._timed, "update",
+                                                                                  thermometer.update, thermometer, dt))
+        concurrent.futures.wait([job for job, dt in jobs.values()], timeout=deadline)
+        return self._collect(jobs, skipped, deadline, keep_pending=True)
+
+    def init(self, thermometers, deadline):
+        """ Take the first reading of all thermometers, waiting at most deadline seconds.
+        Returns dict thermometer -> status block. """
+        jobs, skipped = self._start(thermometers, None,
+                                    lambda thermometer, dt: self._executor.submit(self._timed, "init",
+                                                                                  thermometer.init, thermometer))
+        concurrent.futures.wait([job for job, dt in jobs.values()], timeout=deadline)
+        return self._collect(jobs, skipped, deadline, keep_pending=True)
+
+class AsyncAcquisition(_Acquisition):
+    """ Runs thermometer updates as tasks in the running event loop.
+
+    Sensors that miss the deadline are cancelled and their last known
+    status is reported (marked as stale). """
+
+    async def update(self, thermometers, dt, deadline):
+        """ Asyncio counterpart of ParallelAcquisition.update. """
+        jobs, skipped = self._start(thermometers, dt,
+                                    lambda thermometer, dt: asyncio.ensure_future(
+                                        self._timed_async("update", thermometer.update_async, thermometer, dt)))
+        if jobs:
+            await asyncio.wait([job for job, dt in jobs.values()], timeout=deadline)
+        return self._collect(jobs, skipped, deadline, keep_pending=False)
+
+    async def init(self, thermometers, deadline):
+        """ Asyncio counterpart of ParallelAcquisition.init. """
+        jobs, skipped = self._start(thermometers, None,
+                                    lambda thermometer, dt: asyncio.ensure_future(
+                                        self._timed_async("init", thermometer.init_async, thermometer)))
+        if jobs:
+            await asyncio.wait([job for job, dt in jobs.values()], timeout=deadline)
+        return self._collect(jobs, skipped, deadline, keep_pending=False)
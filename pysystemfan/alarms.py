@@ -0,0 +1,98 @@
+""" Wakeups from hwmon alarm attributes.
+
+Hwmon drivers that support it call sysfs_notify on alarm attributes (temp1_alarm,
+temp1_crit_alarm, fan1_alarm, ...) when they change, which shows up as EPOLLPRI.
+The attributes are registered in an epoll object, so that the same descriptor can be
+waited on with a timeout in the blocking loop and added as a reader to an asyncio loop.
+Attributes of drivers that never notify are harmless, they just never wake us. """
+
+import asyncio
+import logging
+import os
+import select
+
+logger = logging.getLogger(__name__)
+
+class Alarms:
+    def __init__(self):
+        self._epoll = select.epoll()
+        self._attributes = {} # fd -> (path, list of fans)
+
+    def close(self):
+        self._unwatch()
+        self._epoll.close()
+
+    def _unwatch(self):
+        for fd in self._attributes:
+            self._epoll.unregister(fd)
+            os.close(fd)
+        self._attributes = {}
+
+    def watch(self, fans):
+        """ Replace the watched attributes with the alarm attributes of the given fans. """
+        self._unwatch()
+
+        paths = {}
+        for f in fans:
+            for path in f.alarm_paths():
+                paths.setdefault(path, []).append(f)
+
+        for path, path_fans in paths.items():
+            try:
+                fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+            except OSError as e:
+                logger.warning("Can't watch alarm %s (%s)", path, e)
+                continue
+            try:
+                os.pread(fd, 4096, 0) # Notifications only come after the attribute was read
+                self._epoll.register(fd, select.EPOLLPRI | select.EPOLLERR)
+            except OSError as e:
+                logger.warning("Can't watch alarm %s (%s)", path, e)
+                os.close(fd)
+                continue
+            self._attributes[fd] = (path, path_fans)
+
+        if self._attributes:
+            logger.info("Watching %d hwmon alarm attributes", len(self._attributes))
+
+    def wait(self, timeout):
+        """ Wait up to timeout seconds for an alarm,
+        return list of fans whose alarm attributes changed (empty on timeout). """
+        return self._handle(self._epoll.poll(timeout))
+
+    async def wait_async(self, timeout):
+        """ Asyncio version of wait. """
+        if not self._attributes:
+            await asyncio.sleep(timeout)
+            return []
+
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        loop.add_reader(self._epoll.fileno(), lambda: ready.done() or ready.set_result(None))
+        try:
+            await asyncio.wait_for(ready, timeout)
+        except asyncio.TimeoutError:
+            return []
+        finally:
+            loop.remove_reader(self._epoll.fileno())
+        return self._handle(self._epoll.poll(0))
+
+    def _handle(self, events):
+        fans = []
+        for fd, event_mask in events:
+            path, path_fans = self._attributes[fd]
+            try:
+                value = os.pread(fd, 4096, 0).decode("ascii").strip() # Reading re-arms the notification
+            except OSError as e:
+                logger.warning("Can't read alarm %s, not watching it any more (%s)", path, e)
+                self._epoll.unregister(fd)
+                os.close(fd)
+                del self._attributes[fd]
+                continue
+
+            if value != "0":
+                logger.warning("Alarm %s raised (%s)", path, value)
+            else:
+                logger.info("Alarm %s cleared", path)
+            fans.extend(f for f in path_fans if f not in fans)
+        return fans
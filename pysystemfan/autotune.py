@@ -0,0 +1,191 @@
+""" Step response experiment for suggesting PID constants of a fan.
+
+The fan is held at full power until temperatures settle, then PWM is stepped down
+and the response of the maximal normalized temperature error is recorded.
+A first order plus dead time model is fitted to it (two point method) and
+PID constants are computed using SIMC rules.
+Target temperatures are hard limits, if any of them is exceeded the experiment
+is aborted and the fan goes to full power. """
+
+from . import config_params
+
+import collections
+import logging
+
+logger = logging.getLogger(__name__)
+
+class Autotune(config_params.Configurable):
+    _params = [
+        ("step_pwm", 0, "PWM to step down to from full power. "
+                        "Zero (the default) means halfway between min_pwm of the fan and full power."),
+        ("steady_window", 15 * 60, "Length of the window used to decide that the temperatures are steady (seconds)."),
+        ("steady_threshold", 0.2, "Temperatures are steady when the normalized error changes by less than this "
+                                  "over the steady window."),
+        ("max_phase_time", 6 * 60 * 60, "Maximal time to wait for temperatures to settle in each phase (seconds)."),
+        ("closed_loop_time", 0, "Desired closed loop time constant for the SIMC rules (seconds). "
+                                "Zero (the default) means equal to the identified time constant, "
+                                "which gives smooth, slower control. Shorter times make the control tighter."),
+    ]
+
+    def __init__(self, parent, params):
+        self.process_params(params)
+
+    def start(self, fans):
+        """ Start experiments with all fans, returns list of experiments. """
+        self._experiments = [_FanExperiment(self, f) for f in fans]
+        return self._experiments
+
+    def update(self, dt, thermometers_status):
+        """ Advance all experiments, return True once all of them are finished.
+        thermometers_status is a dict thermometer -> status block from the sensor acquisition. """
+        for experiment in self._experiments:
+            if not experiment.done:
+                experiment.update(dt, thermometers_status)
+        return all(experiment.done for experiment in self._experiments)
+
+    def results(self):
+        return {experiment.fan.name: experiment.result for experiment in self._experiments}
+
+class _SteadyDetector:
+    """ Decides whether a signal is steady using linear regression over a time window. """
+
+    def __init__(self, window, threshold):
+        self._window = window
+        self._threshold = threshold
+        self._samples = collections.deque()
+
+    def reset(self):
+        self._samples.clear()
+
+    def update(self, t, value):
+        self._samples.append((t, value))
+        while self._samples[-1][0] - self._samples[0][0] > self._window:
+            self._samples.popleft()
+
+    def is_steady(self):
+        if len(self._samples) < 3 or self._samples[-1][0] - self._samples[0][0] < self._window * 0.9:
+            return False
+
+        n = len(self._samples)
+        mean_t = sum(t for t, v in self._samples) / n
+        mean_v = sum(v for t, v in self._samples) / n
+        var_t = sum((t - mean_t)**2 for t, v in self._samples)
+        cov = sum((t - mean_t) * (v - mean_v) for t, v in self._samples)
+        slope = cov / var_t
+
+        return abs(slope) * self._window < self._threshold
+
+    def mean(self):
+        return sum(v for t, v in self._samples) / len(self._samples)
+
+class _FanExperiment:
+    def __init__(self, settings, fan):
+        self.settings = settings
+        self.fan = fan
+        self.done = False
+        self.result = None
+
+        if settings.step_pwm > 0:
+            self._low_pwm = settings.step_pwm
+        else:
+            self._low_pwm = (fan.min_pwm + 255) // 2
+        self._high_pwm = 255
+
+        self._steady = _SteadyDetector(settings.steady_window, settings.steady_threshold)
+        self._t = 0
+        self._phase_start = 0
+        self._phase = "high"
+        self._response = [] # (time since step, max error) after the step
+        self._initial_error = None
+        self._missing_time = 0 # How long some of the readings are missing or stale
+
+        logger.info("Autotune of %s: waiting for temperatures to settle at full power", fan.name)
+        fan.set_pwm_checked(self._high_pwm)
+
+    def _abort(self, reason):
+        logger.warning("Autotune of %s aborted: %s", self.fan.name, reason)
+        self.fan.set_pwm_checked(255)
+        self.result = {"error": reason}
+        self.done = True
+
+    def update(self, dt, thermometers_status):
+        self._t += dt
+        phase_time = self._t - self._phase_start
+
+        missing = [thermometer.name for thermometer in self.fan.thermometers
+                   if thermometer.get_cached_temperature() is None or
+                      thermometers_status[thermometer].get("stale")]
+        if missing:
+            # Wait for fresh readings, unless they are missing for too long to trust the limits
+            self._missing_time += dt
+            if self._missing_time > self.fan.max_reading_age:
+                self._abort("no fresh readings of {}".format(", ".join(missing)))
+            return
+        self._missing_time = 0
+
+        for thermometer in self.fan.thermometers:
+            if thermometer.get_cached_temperature() > thermometer.target_temperature:
+                self._abort("{} exceeded target temperature".format(thermometer.name))
+                return
+
+        error = max(thermometer.get_normalized_temperature_error() for thermometer in self.fan.thermometers)
+        self._steady.update(self._t, error)
+
+        if self._phase == "high":
+            if self._steady.is_steady() or phase_time > self.settings.max_phase_time:
+                self._initial_error = self._steady.mean()
+                self._steady.reset()
+                self._phase = "step"
+                self._phase_start = self._t
+                logger.info("Autotune of %s: stepping down to PWM %d", self.fan.name, self._low_pwm)
+                self.fan.set_pwm_checked(self._low_pwm)
+        else:
+            self._response.append((phase_time, error))
+            if self._steady.is_steady() or phase_time > self.settings.max_phase_time:
+                self._finish(self._steady.mean())
+
+    def _finish(self, final_error):
+        self.fan.set_pwm_checked(255)
+        self.done = True
+
+        delta_error = final_error - self._initial_error
+        delta_pwm = self._low_pwm - self._high_pwm
+        if delta_error <= 0:
+            self._abort("no temperature response to the PWM step")
+            return
+
+        t28 = self._crossing_time(self._initial_error + 0.283 * delta_error)
+        t63 = self._crossing_time(self._initial_error + 0.632 * delta_error)
+        time_constant = max(1.5 * (t63 - t28), 1)
+        dead_time = max(t63 - time_constant, 0)
+        gain = delta_error / delta_pwm # Normalized error per PWM step, negative
+
+        closed_loop_time = self.settings.closed_loop_time
+        if closed_loop_time <= 0:
+            closed_loop_time = max(time_constant, dead_time)
+
+        kP = time_constant / (-gain * (closed_loop_time + dead_time))
+        integral_time = min(time_constant, 4 * (closed_loop_time + dead_time))
+        derivative_time = dead_time / 2
+
+        self.result = {
+            "gain": gain,
+            "time_constant": time_constant,
+            "dead_time": dead_time,
+            "kP": kP,
+            "kI": kP / integral_time,
+            "kD": kP * derivative_time,
+            "derivative_smoothing": max(derivative_time, 1),
+        }
+        logger.info("Autotune of %s finished: %s", self.fan.name, self.result)
+
+    def _crossing_time(self, level):
+        """ Return linearly interpolated time when the recorded response first crosses level. """
+        previous_t, previous_error = 0, self._initial_error
+        for t, error in self._response:
+            if error >= level:
+                if error == previous_error:
+                    return t
+                return previous_t + (t - previous_t) * (level - previous_error) / (error - previous_error)
+            previous_t, previous_error = t, error
+        return self._response[-1][0]
@@ -0,0 +1,143 @@
+""" Measurement of the fan stall and start thresholds and of its PWM to RPM curve. """
+
+from . import config_params
+from . import util
+
+import bisect
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class FanCurve:
+    """ Calibrated properties of a fan.
+    stall_pwm is the lowest PWM that keeps a running fan spinning, start_pwm the lowest
+    PWM that starts a stopped fan, points a list of (pwm, rpm) pairs sorted by PWM. """
+
+    def __init__(self, stall_pwm, start_pwm, points):
+        self.stall_pwm = stall_pwm
+        self.start_pwm = start_pwm
+        self.points = points
+
+        # RPM made non decreasing, so that it can be inverted
+        self._pwms = [pwm for pwm, rpm in points]
+        self._rpms = []
+        for pwm, rpm in points:
+            self._rpms.append(max(rpm, self._rpms[-1]) if self._rpms else rpm)
+
+    @property
+    def max_rpm(self):
+        return self._rpms[-1]
+
+    def pwm_for_rpm(self, rpm):
+        """ Return PWM that gives rpm, linearly interpolated between the measured points. """
+        i = bisect.bisect_left(self._rpms, rpm)
+        if i == 0:
+            return self._pwms[0]
+        if i == len(self._rpms):
+            return self._pwms[-1]
+        rpm0, rpm1 = self._rpms[i - 1], self._rpms[i]
+        pwm0, pwm1 = self._pwms[i - 1], self._pwms[i]
+        return pwm0 + (pwm1 - pwm0) * (rpm - rpm0) / (rpm1 - rpm0)
+
+    def get_state(self):
+        return {"stall_pwm": self.stall_pwm,
+                "start_pwm": self.start_pwm,
+                "points": [[pwm, rpm] for pwm, rpm in self.points]}
+
+    @classmethod
+    def from_state(cls, state):
+        """ Construct the curve from get_state output.
+        Raises KeyError, TypeError or ValueError if the state is not valid. """
+        stall_pwm = int(state["stall_pwm"])
+        start_pwm = int(state["start_pwm"])
+        points = [(int(pwm), util.finite_float(rpm)) for pwm, rpm in state["points"]]
+        if not 0 < stall_pwm <= 255 or not 0 < start_pwm <= 255:
+            raise ValueError("Calibrated PWM out of range")
+        if not points or points != sorted(points):
+            raise ValueError("Invalid PWM curve")
+        return cls(stall_pwm, start_pwm, points)
+
+class Calibration(config_params.Configurable):
+    _params = [
+        ("on_startup", False, "Calibrate the fan when the controler starts, unless a calibration "
+                              "was restored from the state store. The fan is stopped during the calibration, "
+                              "if any of its thermometers exceeds the target temperature, the calibration "
+                              "is aborted and the fan goes to full power."),
+        ("linearize", False, "Use the measured curve to make the fan speed proportional to the controller output."),
+        ("margin", 8, "PWM added to the measured stall and start thresholds."),
+        ("settle_time", 5, "Time between speed readings while waiting for the speed to settle (seconds)."),
+        ("settle_tolerance", 0.05, "Speed is settled when two consecutive readings differ by less than this fraction."),
+        ("stop_timeout", 30, "Maximal time to wait for the fan speed to settle or for the fan to stop (seconds)."),
+        ("curve_points", 8, "Number of points of the PWM to RPM curve."),
+    ]
+
+    def __init__(self, parent, params):
+        self.process_params(params)
+
+    def run(self, fan, wait = time.sleep):
+        """ Measure the fan, return FanCurve. wait(seconds) is used for all waiting.
+        Both thresholds are found by bisection, the stall threshold starting from full speed
+        and the start threshold starting from a stopped fan, because starting needs more power. """
+        logger.info("Calibrating %s", fan.name)
+
+        def spinning_at(pwm):
+            fan.set_pwm(pwm)
+            return self._settled_rpm(fan, wait) > 0
+
+        if not spinning_at(255):
+            raise RuntimeError("{} doesn't spin at full power".format(fan.name))
+
+        def keeps_running(pwm):
+            spinning_at(255)
+            return spinning_at(pwm)
+
+        stall_pwm = self._bisect(keeps_running, 0, 255)
+
+        def starts(pwm):
+            fan.set_pwm(0)
+            waited = 0
+            while fan.get_rpm() > 0 and waited < self.stop_timeout:
+                wait(self.settle_time)
+                waited += self.settle_time
+            return spinning_at(pwm)
+
+        start_pwm = self._bisect(starts, stall_pwm - 1, 255)
+
+        spinning_at(255)
+        points = []
+        for i in range(self.curve_points):
+            pwm = round(255 - (255 - stall_pwm) * i / max(self.curve_points - 1, 1))
+            fan.set_pwm(pwm)
+            points.append((pwm, self._settled_rpm(fan, wait)))
+        points.sort()
+
+        curve = FanCurve(stall_pwm, start_pwm, points)
+        logger.info("Calibrated %s: stall at PWM %d, start at PWM %d, %d rpm at full power",
+                    fan.name, stall_pwm, start_pwm, curve.max_rpm)
+        return curve
+
+    def _settled_rpm(self, fan, wait):
+        """ Wait until the fan speed stops changing, return the last reading.
+        A decelerating fan keeps reading non zero speed for a while even when it has stalled. """
+        rpm = fan.get_rpm()
+        waited = 0
+        while waited < self.stop_timeout:
+            wait(self.settle_time)
+            waited += self.settle_time
+            previous, rpm = rpm, fan.get_rpm()
+            if abs(rpm - previous) <= self.settle_tolerance * max(previous, rpm):
+                break
+        return rpm
+
+    @staticmethod
+    def _bisect(predicate, low, high):
+        """ Return the lowest value in (low, high] for which predicate is true,
+        assuming that it is false at low and true at high. """
+        while high - low > 1:
+            middle = (low + high) // 2
+            if predicate(middle):
+                high = middle
+            else:
+                low = middle
+        return high
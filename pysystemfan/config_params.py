@@ -1,4 +1,9 @@
 import collections
+import logging
+
+logger = logging.getLogger(__name__)
+
+_params_schemas = {} # class -> list of (name, default, description) including base classes
 
 class Configurable:
     """Classes inheriting from Configurable must define a class variable _params,
@@ -13,6 +18,9 @@ class Configurable:
             -- None -- variable is required
             -- ListOf(cls) - variable is a optional list of dicts, cls instances
                              get constructed from them. (as cls(self, parameters))
+                             If ListOf has references set, items of the list can also be
+                             strings, which get resolved to existing instances by calling
+                             method of that name on self.
             -- InstanceOf(cls, missing) - variable is dict, cls instance get
                                           constructed from it. (as cls(self, parameters)).
                                           If the variable is not present, behavior depends
@@ -21,12 +29,23 @@ class Configurable:
                                           anything else -- uses this as an argument to the class
                                           constructor.
 
+    Parameters can be updated in place from a new config using reload_params.
+    Names listed in _restart_params keep their old value on reload, because
+    changing them requires a restart.
     """
 
+    _restart_params = ()
+
     def _params_iter(self):
-        used_names = set()
+        cls = self.__class__
+        try:
+            return iter(_params_schemas[cls])
+        except KeyError:
+            pass
 
-        for klass in self.__class__.mro():
+        schema = []
+        used_names = set()
+        for klass in cls.mro():
             try:
                 params = klass._params
             except AttributeError:
@@ -36,7 +55,17 @@ class Configurable:
                 if name in used_names:
                     continue
                 used_names.add(name)
-                yield (name, default, description)
+                schema.append((name, default, description))
+
+        _params_schemas[cls] = schema
+        return iter(schema)
+
+    def _check_unused_params(self, params, used_names):
+        unused_param_names = set(params) - used_names
+        unused_param_names.difference_update(param for param in params if param[0] == "_")
+
+        if len(unused_param_names):
+            raise RuntimeError("Parameters " + ", ".join(sorted(unused_param_names)) + " were not used")
 
     def process_params(self, params):
         used_names = set()
@@ -58,11 +87,44 @@ class Configurable:
             setattr(self, name, value)
             used_names.add(name)
 
-        unused_param_names = set(params) - used_names
-        unused_param_names.difference_update(param for param in params if param[0] == "_")
+        self._check_unused_params(params, used_names)
 
-        if len(unused_param_names):
-            raise RuntimeError("Parameters " + ", ".join(sorted(unused_param_names)) + " were not used")
+    def reload_params(self, parent, params):
+        """ Update parameters from a new config in place.
+        Objects in InstanceOf and ListOf parameters are reloaded recursively if they keep
+        their class (and name in lists), otherwise they are constructed anew.
+        Calls params_reloaded with a dict of the old values afterwards. """
+        self._check_unused_params(params, set(name for name, default, description in self._params_iter()))
+
+        old_values = {}
+        for name, default, description in self._params_iter():
+            old_value = getattr(self, name)
+            if isinstance(default, ListOf):
+                value = default.reload(self, old_value, params.get(name, []))
+            elif isinstance(default, InstanceOf):
+                if default.missing == Exception and name not in params:
+                    value = None
+                else:
+                    value = default.reload(self, old_value, params.get(name, default.missing))
+            else:
+                value = params.get(name, default)
+
+            if value is None:
+                raise RuntimeError("Value of parameter " + name + " must be set")
+
+            if name in self._restart_params and value != old_value:
+                logger.warning("Parameter %s of %s can't be changed without restart", name, self.__class__.__name__)
+                continue
+
+            setattr(self, name, value)
+            old_values[name] = old_value
+
+        self.params_reloaded(parent, old_values)
+
+    def params_reloaded(self, parent, old_values):
+        """ Called after reload_params, old_values is a dict of parameter values before the reload.
+        Override to update state derived from the parameters. """
+        pass
 
     def dump_params(self, include_defaults = False):
         ret = collections.OrderedDict()
@@ -77,11 +139,30 @@ class Configurable:
         return ret
 
 class ListOf:
-    def __init__(self, classes):
+    def __init__(self, classes, references = None):
         self.classes = classes
+        self.references = references
 
     def load(self, parent, data):
-        return [InstanceOf._load(parent, item, self.classes) for item in data]
+        return [self._load_item(parent, item) for item in data]
+
+    def _load_item(self, parent, item):
+        if isinstance(item, str):
+            if self.references is None:
+                raise RuntimeError("Reference " + item + " used where references are not allowed")
+            return getattr(parent, self.references)(item)
+        return InstanceOf._load(parent, item, self.classes)
+
+    def reload(self, parent, old_items, data):
+        """ Return list loaded from data, reusing items from old_items with matching name and class. """
+        old_by_name = {item.name: item for item in old_items}
+        ret = []
+        for item in data:
+            if isinstance(item, str):
+                ret.append(self._load_item(parent, item))
+            else:
+                ret.append(InstanceOf._reload(parent, old_by_name.get(item.get("name")), item, self.classes))
+        return ret
 
     def dump(self, data, include_defaults):
         if not include_defaults and not len(data):
@@ -96,25 +177,38 @@ class InstanceOf:
     def load(self, parent, data):
         return self._load(parent, data, self.classes)
 
+    def reload(self, parent, old, data):
+        """ Return instance loaded from data, reusing old if it has the right class. """
+        return self._reload(parent, old, data, self.classes)
+
     @staticmethod
-    def _load(parent, data, classes):
+    def _class(data, classes):
+        """ Select class from classes based on the "class" item in data, removes the item. """
         if len(classes) == 1:
-            cls = classes[0]
-        else:
-            try:
-                cls_name = data.pop("class")
-            except KeyError:
-                raise RuntimeError("Value of parameter " + name + " must be set") from None
-
-            cls = None
-            for candidate in classes:
-                if candidate.__name__ == cls_name:
-                    cls = candidate
-                    break
-            if cls is None:
-                raise RuntimeError("No matching class found. Possible values are: " +
-                                   ", ".join(candidate.__name__ for candidate in classes)) from None
+            return classes[0]
+
+        try:
+            cls_name = data.pop("class")
+        except KeyError:
+            raise RuntimeError("Value of parameter class must be set") from None
+
+        for candidate in classes:
+            if candidate.__name__ == cls_name:
+                return candidate
 
+        raise RuntimeError("No matching class found. Possible values are: " +
+                           ", ".join(candidate.__name__ for candidate in classes)) from None
+
+    @staticmethod
+    def _load(parent, data, classes):
+        return InstanceOf._class(data, classes)(parent, data)
+
+    @staticmethod
+    def _reload(parent, old, data, classes):
+        cls = InstanceOf._class(data, classes)
+        if old is not None and old.__class__ is cls:
+            old.reload_params(parent, data)
+            return old
         return cls(parent, data)
 
     @staticmethod
@@ -1,10 +1,18 @@
+from . import acquisition
+from . import alarms
+from . import autotune
 from . import config_params
 from . import fan
+from . import state_store
 from . import status_server
+from . import timing
 from . import util
 
+import asyncio
 import contextlib
 import argparse
+import copy
+import signal
 import time
 import datetime
 import json
@@ -20,16 +28,53 @@ class Controler(config_params.Configurable):
                                  "One of DEBUG, INFO, WARNING, ERROR, CRITICAL"),
         ("min_rpm_probe_interval", 30 * 24 * 60 * 60, "How often to try decreasing the minimum fan speed when one is already learned"),
         ("update_time", 30, "Time between updates in seconds."),
+        ("min_update_time", 0, "Time between updates when a predicted temperature error of any fan approaches zero. "
+                               "Zero (the default) means update_time."),
+        ("max_update_time", 0, "Longest time between updates. The period is gradually lengthened up to this value "
+                               "while all errors are well below zero and not changing. "
+                               "Zero (the default) means update_time."),
+        ("quiet_error", -2, "Predicted errors of all fans must be below this for the update period to be lengthened. "
+                            "Errors must also be flat enough to not change by more than half of this "
+                            "during max_update_time."),
+        ("approach_error", -0.5, "Update period drops to min_update_time when any predicted error is rising "
+                                 "and above this value."),
+        ("runtime", "threads", "How to run the control loop. \"threads\" runs a blocking loop, reads sensors "
+                               "in a thread pool and serves status in a separate thread, \"asyncio\" runs "
+                               "the loop, sensor reads and the status server in a single event loop."),
+        ("rpm_watch_interval", 0.25, "How often to read speed of fans that are spinning up or settling "
+                                     "at minimal PWM between updates (seconds). A fan that stops triggers "
+                                     "an immediate update. Zero disables the watching."),
+        ("hwmon_alarms", True, "Update immediately when a hwmon alarm attribute next to the input of a fan "
+                               "or of its thermometers (temp1_alarm, temp1_crit_alarm, fan1_alarm, ...) changes, "
+                               "instead of waiting for the next update."),
+        ("sensor_threads", 16, "Maximal number of thermometers that are read in parallel."),
+        ("sensor_deadline", 0, "How long to wait for thermometer readings in one update (seconds). "
+                               "Readings that take longer are reported as stale and picked up in a later update. "
+                               "Zero (the default) means half of update_time."),
+        ("thermometers", config_params.ListOf(fan.thermometer_classes),
+         "Thermometers shared by several fans, fans refer to them by name in their thermometers list. "
+         "Each one is read only once per update regardless of how many fans use it."),
         ("fans", config_params.ListOf([fan.SystemFan,
                                        fan.MockFan]), ""),
         ("status_server", config_params.InstanceOf([status_server.StatusServer], {}), ""),
+        ("state_store", config_params.InstanceOf([state_store.StateStore], {}),
+         "Storage that keeps learned state of fans and thermometers across restarts."),
+        ("autotune", config_params.InstanceOf([autotune.Autotune], {}), "Settings of the autotune run mode."),
     ]
 
+    _restart_params = ("log_file", "runtime", "sensor_threads")
+
     def __init__(self, config = None, **extra_args):
+        self._init_time = time.time()
+        self.timings = timing.Timings()
+
         if config is None:
-            self._load_config("pysystemfan.json")
+            self._config_path = "pysystemfan.json"
         else:
-            self._load_config(config)
+            self._config_path = config
+        self._load_config(self._config_path)
+        self._check_config()
+        self._reload_requested = False
 
         logging_config = {
             "level": logging.getLevelName(self.log_level),
@@ -46,9 +91,16 @@ class Controler(config_params.Configurable):
 
         self._extra_args = extra_args
 
-        duplicate_fan_names = util.duplicates(fan.name for fan in self.fans)
-        if duplicate_fan_names:
-            raise ValueError("Duplicate fan names: {}".format(", ".join(duplicate_fan_names)))
+        self._update_period = _UpdatePeriod(self)
+
+        if self.runtime == "threads":
+            self._acquisition = acquisition.ParallelAcquisition(self.sensor_threads, self.timings)
+        else:
+            self._acquisition = acquisition.AsyncAcquisition(self.timings)
+
+        self._alarms = alarms.Alarms()
+
+        self._restore_state()
 
     def _load_config(self, path):
         with open(path, "r") as fp:
@@ -56,49 +108,421 @@ class Controler(config_params.Configurable):
 
         self.process_params(config)
 
+    def _check_config(self):
+        duplicate_fan_names = util.duplicates(fan.name for fan in self.fans)
+        if duplicate_fan_names:
+            raise ValueError("Duplicate fan names: {}".format(", ".join(duplicate_fan_names)))
+
+        duplicate_thermometer_names = util.duplicates(thermometer.name for thermometer in self.thermometers)
+        if duplicate_thermometer_names:
+            raise ValueError("Duplicate shared thermometer names: {}".format(", ".join(duplicate_thermometer_names)))
+
+        if self.runtime not in ("threads", "asyncio"):
+            raise ValueError("Unknown runtime " + self.runtime)
+
+    def request_reload(self, *args):
+        """ Ask for the config to be reloaded before the next update (SIGHUP handler). """
+        self._reload_requested = True
+
+    def _reload_config(self):
+        """ Re-read the config file and apply it to the live objects.
+        Returns set of thermometers that were added. """
+        with open(self._config_path, "r") as fp:
+            config = json.load(fp)
+
+        # Load the config into a throwaway tree first, so that an invalid
+        # config gets rejected before anything is modified
+        validation = Controler.__new__(Controler)
+        try:
+            validation.process_params(copy.deepcopy(config))
+            validation._check_config()
+        finally:
+            for t in getattr(validation, "thermometers", []):
+                t.close()
+            for f in getattr(validation, "fans", []):
+                for t in f.thermometers:
+                    t.close()
+
+        old_thermometers = set(self._thermometers())
+        self.reload_params(None, config)
+        return set(self._thermometers()) - old_thermometers
+
+    def params_reloaded(self, parent, old_values):
+        logging.getLogger().setLevel(logging.getLevelName(self.log_level))
+        self._update_period = _UpdatePeriod(self)
+
+        for f in old_values["fans"]:
+            if f not in self.fans:
+                logger.info("Fan %s removed from config, setting it to 100%% power", f.name)
+                f.set_pwm_checked(255)
+                for t in f._own_thermometers():
+                    t.close()
+        for t in old_values["thermometers"]:
+            if t not in self.thermometers:
+                t.close()
+
+    def reload(self):
+        """ Apply changes from the config file without losing state of the unchanged objects.
+        Added fans are started from the first readings of their thermometers. """
+        old_fans = list(self.fans)
+        try:
+            added_thermometers = self._reload_config()
+        except (OSError, ValueError, RuntimeError) as e:
+            logger.error("Can't reload config, keeping the old one (%s)", e)
+            return
+        self._acquisition.init(added_thermometers, self._sensor_deadline())
+        self._start_added_fans(old_fans)
+
+    async def reload_async(self):
+        """ Asyncio version of reload. """
+        old_fans = list(self.fans)
+        try:
+            added_thermometers = self._reload_config()
+        except (OSError, ValueError, RuntimeError) as e:
+            logger.error("Can't reload config, keeping the old one (%s)", e)
+            return
+        await self._acquisition.init(added_thermometers, self._sensor_deadline())
+        self._start_added_fans(old_fans)
+
+    def _start_added_fans(self, old_fans):
+        for f in self.fans:
+            if f not in old_fans:
+                f.start(self.update_time)
+        self._watch_alarms()
+        logger.info("Config reloaded")
+
+    def _watch_alarms(self):
+        self._alarms.watch(self.fans if self.hwmon_alarms else [])
+
+    def _alarms_fired(self, fans):
+        if fans:
+            logger.info("Alarm of %s, updating immediately", ", ".join(f.name for f in fans))
+        return len(fans) > 0
+
+    def _get_state(self):
+        return {"fans": {f.name: f.get_state() for f in self.fans},
+                "thermometers": {t.name: t.get_state() for t in self.thermometers}}
+
+    def save_state(self):
+        self.state_store.save(self._get_state())
+
+    def _restore_state(self):
+        """ Load state saved by an earlier run and show the restored values in status. """
+        loaded = self.state_store.load()
+        if loaded is None:
+            return
+        state, age = loaded
+
+        restored = {"age": age, "fans": {}, "thermometers": {}}
+        for kind, objects in (("fans", self.fans), ("thermometers", self.thermometers)):
+            saved = state.get(kind, {})
+            for obj in objects:
+                if obj.name not in saved:
+                    continue
+                try:
+                    restored_values = obj.restore_state(saved[obj.name], age)
+                except (KeyError, TypeError, ValueError) as e:
+                    logger.warning("Can't restore saved state of %s (%s: %s)", obj.name, e.__class__.__name__, e)
+                    continue
+                if restored_values is not None:
+                    restored[kind][obj.name] = restored_values
+
+        logger.info("Restored state saved %.0fs ago", age)
+        self.status_server["restored_state"] = restored
+
     def full_steam(self):
         logger.info("Setting all fans to 100% power.")
         for fan in self.fans:
             fan.set_pwm_checked(255)
 
     def update_forever(self):
-        last_update = time.time()
+        last_update = self.start()
         next_update = last_update + self.update_time
 
         while True:
-            util.sleep_until(next_update)
+            self._sleep_until(next_update)
+            if self._reload_requested:
+                self._reload_requested = False
+                self.reload()
             last_update, next_update = self.update(last_update)
 
+    async def update_forever_async(self):
+        async with self.status_server:
+            last_update = await self.start_async()
+            next_update = last_update + self.update_time
+
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self.request_reload)
+
+            while True:
+                await self._sleep_until_async(next_update)
+                if self._reload_requested:
+                    self._reload_requested = False
+                    await self.reload_async()
+                last_update, next_update = await self.update_async(last_update)
+
+    def _watched_fans(self):
+        if self.rpm_watch_interval <= 0:
+            return []
+        return [f for f in self.fans if f.watching()]
+
+    def _watch_fans(self, fans, dt):
+        """ Read speed of the watched fans, dt seconds after the previous reading.
+        Return True if some of them needs an update now. """
+        stalled = [f.name for f in fans if f.watch(dt)]
+        if stalled:
+            logger.info("%s stopped, updating immediately", ", ".join(stalled))
+        return len(stalled) > 0
+
+    def _sleep_step(self, t):
+        """ Return list of fans to watch and time to wait in one step of sleeping until t. """
+        fans = self._watched_fans()
+        remaining = max(t - time.time(), 0) # Negative timeout would mean waiting forever
+        if fans:
+            return fans, min(remaining, self.rpm_watch_interval)
+        return fans, remaining
+
+    def _sleep_until(self, t):
+        """ Sleep until t, waiting for hwmon alarms and watching speed of the fans that
+        are starting or settling. Returns earlier if an alarm comes or a fan stops. """
+        if t < time.time():
+            util.sleep_until(t) # Only logs the overrun
+            return
+        while time.time() < t:
+            fans, timeout = self._sleep_step(t)
+            step_start = time.time()
+            if self._alarms_fired(self._alarms.wait(timeout)):
+                return
+            if fans and self._watch_fans(fans, time.time() - step_start):
+                return
+
+    async def _sleep_until_async(self, t):
+        """ Asyncio version of _sleep_until. """
+        if t < time.time():
+            await util.sleep_until_async(t)
+            return
+        while time.time() < t:
+            fans, timeout = self._sleep_step(t)
+            step_start = time.time()
+            if self._alarms_fired(await self._alarms.wait_async(timeout)):
+                return
+            if fans and self._watch_fans(fans, time.time() - step_start):
+                return
+
+    def _sensor_deadline(self):
+        if self.sensor_deadline > 0:
+            return self.sensor_deadline
+        else:
+            return self.update_time / 2
+
+    def _thermometers(self):
+        """ Iterate over all thermometers, shared ones may appear more than once. """
+        yield from self.thermometers
+        for f in self.fans:
+            yield from f.thermometers
+
+    def start(self):
+        """ Read all thermometers concurrently and start the fans at PWM based on the readings.
+        Returns time of the start. """
+        self._acquisition.init(self._thermometers(), self._sensor_deadline())
+        for f in self._fans_to_calibrate():
+            self._calibrate_fan(f)
+        return self._start_fans()
+
+    async def start_async(self):
+        """ Asyncio version of start. """
+        await self._acquisition.init(self._thermometers(), self._sensor_deadline())
+        for f in self._fans_to_calibrate():
+            await asyncio.get_running_loop().run_in_executor(None, self._calibrate_fan, f)
+        return self._start_fans()
+
+    def _fans_to_calibrate(self):
+        return [f for f in self.fans if f.calibration.on_startup and not f.is_calibrated()]
+
+    def _calibrate_fan(self, f):
+        """ Calibrate the fan, return the curve or None if the calibration failed. """
+        try:
+            return f.calibrate()
+        except (OSError, RuntimeError) as e:
+            logger.error("Calibration of %s failed (%s)", f.name, e)
+            return None
+
+    def _start_fans(self):
+        for f in self.fans:
+            f.start(self.update_time)
+        self._watch_alarms()
+
+        now = time.time()
+        startup_time = now - self._init_time
+        logger.info("Startup took %.1fs", startup_time)
+        self.status_server["startup_time"] = startup_time
+        self.status_server.update()
+
+        return now
+
     def update(self, last_update):
         """ Update all fans and status server. """
 
         now = time.time()
         dt = now - last_update
-        new_dt = self.update_time
+        thermometers_status = self._acquisition.update(self._thermometers(), dt, self._sensor_deadline())
+        return self._update_fans(now, dt, thermometers_status)
 
+    async def update_async(self, last_update):
+        """ Asyncio version of update. """
+
+        now = time.time()
+        dt = now - last_update
+        thermometers_status = await self._acquisition.update(self._thermometers(), dt, self._sensor_deadline())
+        return self._update_fans(now, dt, thermometers_status)
+
+    def _update_fans(self, now, dt, thermometers_status):
         fan_status = {}
+        fan_dts = []
         for f in self.fans:
-            fan_dt, status_block = f.update(dt)
+            fan_dt, status_block = f.update(dt, thermometers_status)
             fan_status[f.name] = status_block
-            new_dt = min(new_dt, fan_dt)
+            fan_dts.append(fan_dt)
+
+        period = self._update_period.update(self.fans)
+        new_dt = min([period] + fan_dts)
+
+        # Wake up in time for the next thermometer that has its own update interval
+        for t in thermometers_status:
+            new_dt = min(new_dt, t.time_until_due())
 
         self.status_server["fans"] = fan_status
         self.status_server["last_update"] = datetime.datetime.fromtimestamp(now).isoformat()
         self.status_server["dt"] = new_dt
+        self.status_server["update_period"] = period
+        self.status_server["timings"] = self.timings.summary()
 
         self.status_server.update()
 
+        if self.state_store.checkpoint_due(dt):
+            self.save_state()
+
         return now, now + new_dt
 
-    def run(self):
+    def run_autotune(self, output_path = None):
+        """ Run step response experiments on all fans and write suggested PID constants
+        as JSON to output_path (or stdout if it is None). """
         try:
             with contextlib.ExitStack() as stack:
-                logger.info("PySystemFan started")
-                stack.enter_context(self.status_server)
+                logger.info("PySystemFan autotune started")
+                sensors = stack.enter_context(acquisition.ParallelAcquisition(self.sensor_threads))
                 stack.callback(self.full_steam)
                 stack.enter_context(util.Interrupter())
 
-                self.update_forever()
+                sensors.init(self._thermometers(), self._sensor_deadline())
+                last_update = time.time()
+                self.autotune.start(self.fans)
+
+                done = False
+                while not done:
+                    util.sleep_until(last_update + self.update_time)
+                    now = time.time()
+                    dt = now - last_update
+                    last_update = now
+
+                    thermometers_status = sensors.update(self._thermometers(), dt, self._sensor_deadline())
+                    done = self.autotune.update(dt, thermometers_status)
+
+                results = json.dumps(self.autotune.results(), indent=4)
+                if output_path is None:
+                    print(results)
+                else:
+                    with open(output_path, "w") as fp:
+                        fp.write(results)
+                logger.info("Autotune finished")
 
         except:
             logger.exception("Unhandled exception")
+
+    def run_calibration(self, output_path = None):
+        """ Calibrate all fans, save the results to the state store and write them
+        as JSON to output_path (or stdout if it is None). """
+        try:
+            with contextlib.ExitStack() as stack:
+                logger.info("PySystemFan calibration started")
+                stack.callback(self.full_steam)
+                stack.enter_context(util.Interrupter())
+
+                results = {}
+                for f in self.fans:
+                    curve = self._calibrate_fan(f)
+                    results[f.name] = None if curve is None else curve.get_state()
+                self.save_state()
+
+                results = json.dumps(results, indent=4)
+                if output_path is None:
+                    print(results)
+                else:
+                    with open(output_path, "w") as fp:
+                        fp.write(results)
+                logger.info("Calibration finished")
+
+        except:
+            logger.exception("Unhandled exception")
+
+    def run(self):
+        try:
+            with contextlib.ExitStack() as stack:
+                logger.info("PySystemFan started")
+                stack.callback(self.save_state)
+                stack.callback(self._alarms.close)
+                if self.runtime == "asyncio":
+                    stack.callback(self.full_steam)
+                    stack.enter_context(util.Interrupter())
+
+                    asyncio.run(self.update_forever_async())
+                else:
+                    stack.enter_context(self.status_server)
+                    stack.enter_context(self._acquisition)
+                    stack.callback(self.full_steam)
+                    stack.enter_context(util.Interrupter())
+
+                    signal.signal(signal.SIGHUP, self.request_reload)
+                    self.update_forever()
+
+        except:
+            logger.exception("Unhandled exception")
+
+
+class _UpdatePeriod:
+    """ Helper that adapts time between updates to how close the fans are to their targets. """
+
+    def __init__(self, controler):
+        self.nominal = controler.update_time
+        self.min = controler.min_update_time if controler.min_update_time > 0 else self.nominal
+        self.max = controler.max_update_time if controler.max_update_time > 0 else self.nominal
+        self.quiet_error = controler.quiet_error
+        self.approach_error = controler.approach_error
+        self.value = self.nominal
+
+    def update(self, fans):
+        """ Choose the next update period from the state of PID controllers of the fans. """
+        predicted_error = -float("inf")
+        max_derivative = -float("inf")
+        max_abs_derivative = 0
+        without_pid_state = False
+        for f in fans:
+            if f.pid.get_max_predicted_error() is None:
+                # Fan without readings yet, its temperatures are unknown
+                without_pid_state = True
+                continue
+            predicted_error = max(predicted_error, f.pid.get_max_predicted_error())
+            for d in f.pid.get_derivatives():
+                max_derivative = max(max_derivative, d)
+                max_abs_derivative = max(max_abs_derivative, abs(d))
+
+        if without_pid_state or (predicted_error > self.approach_error and max_derivative > 0):
+            value = self.min
+        elif predicted_error < self.quiet_error and max_abs_derivative * self.max < -self.quiet_error / 2:
+            value = min(max(self.value, self.nominal) * 2, self.max)
+        else:
+            value = self.nominal
+
+        if value != self.value:
+            logger.debug("Changing update period to {:.0f}s".format(value))
+        self.value = value
+        return value
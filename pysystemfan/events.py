@@ -0,0 +1,155 @@
+import json
+import logging
+import selectors
+import socket
+import threading
+
+logger = logging.getLogger(__name__)
+
+_missing = object()
+
+def merge_patch(old, new):
+    """ Return JSON merge patch (RFC 7386) that turns old into new.
+    Like in the RFC, removed keys and keys whose value became null are both sent as null. """
+    patch = {}
+    for key in old:
+        if key not in new:
+            patch[key] = None
+    for key, value in new.items():
+        old_value = old.get(key, _missing)
+        if isinstance(value, dict) and isinstance(old_value, dict):
+            sub_patch = merge_patch(old_value, value)
+            if sub_patch:
+                patch[key] = sub_patch
+        elif old_value is _missing or old_value != value:
+            patch[key] = value
+    return patch
+
+def frame(event, data):
+    """ Format one server-sent event with JSON data. """
+    return "event: {}\ndata: {}\n\n".format(event, json.dumps(data, separators=(",", ":"))).encode("utf-8")
+
+keepalive_frame = b":\n\n"
+keepalive_interval = 15 # Seconds of silence before a keepalive frame is sent
+
+class _Client:
+    def __init__(self, sock, initial_frame):
+        self.sock = sock
+        self.buffer = bytearray(initial_frame)
+        self.needs_snapshot = False # A frame was dropped, next one must be a full snapshot
+        self.events = None
+
+class EventBroadcaster:
+    """ Streams frames to all subscribed sockets from a single thread.
+
+    Every client has at most one frame waiting to be sent. If a new frame arrives
+    while the previous one is still being sent, it is dropped and the client gets
+    a full snapshot once it catches up. Publishing never blocks on clients. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = []
+        self._snapshot_frame = None
+        self._selector = selectors.DefaultSelector()
+        self._wake_receiver, self._wake_sender = socket.socketpair()
+        self._wake_receiver.setblocking(False)
+        self._wake_sender.setblocking(False)
+        self._selector.register(self._wake_receiver, selectors.EVENT_READ)
+        self._running = False
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="Status events")
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._wake()
+        self._thread.join()
+        for client in self._clients:
+            client.sock.close()
+        self._selector.close()
+        self._wake_receiver.close()
+        self._wake_sender.close()
+
+    def _wake(self):
+        try:
+            self._wake_sender.send(b"\0")
+        except BlockingIOError:
+            pass # Already woken up
+
+    def add_client(self, sock, snapshot_frame):
+        """ Take over a connected socket, the HTTP headers must already be sent. """
+        sock.setblocking(False)
+        with self._lock:
+            self._clients.append(_Client(sock, snapshot_frame))
+        self._wake()
+
+    def publish(self, snapshot_frame, delta_frame):
+        with self._lock:
+            self._snapshot_frame = snapshot_frame
+            for client in self._clients:
+                if client.buffer:
+                    client.needs_snapshot = True
+                elif client.needs_snapshot:
+                    client.buffer += snapshot_frame
+                    client.needs_snapshot = False
+                else:
+                    client.buffer += delta_frame
+        self._wake()
+
+    def client_count(self):
+        return len(self._clients)
+
+    def _remove(self, client):
+        self._clients.remove(client)
+        if client.events is not None:
+            self._selector.unregister(client.sock)
+        client.sock.close()
+
+    def _run(self):
+        while self._running:
+            with self._lock:
+                for client in self._clients:
+                    # Always watch for reading to notice closed connections
+                    events = selectors.EVENT_READ
+                    if client.buffer:
+                        events |= selectors.EVENT_WRITE
+                    if client.events is None:
+                        self._selector.register(client.sock, events, client)
+                    elif client.events != events:
+                        self._selector.modify(client.sock, events, client)
+                    client.events = events
+
+            ready = self._selector.select(keepalive_interval)
+            if not ready:
+                with self._lock:
+                    for client in self._clients:
+                        if not client.buffer:
+                            client.buffer += keepalive_frame
+
+            with self._lock:
+                for key, mask in ready:
+                    if key.fileobj is self._wake_receiver:
+                        try:
+                            self._wake_receiver.recv(4096)
+                        except BlockingIOError:
+                            pass
+                        continue
+
+                    client = key.data
+                    try:
+                        if mask & selectors.EVENT_READ and not client.sock.recv(4096):
+                            self._remove(client)
+                            continue
+                        if mask & selectors.EVENT_WRITE:
+                            sent = client.sock.send(client.buffer)
+                            del client.buffer[:sent]
+                            if not client.buffer and client.needs_snapshot:
+                                client.buffer += self._snapshot_frame
+                                client.needs_snapshot = False
+                    except BlockingIOError:
+                        pass
+                    except OSError as e:
+                        logger.debug("Event client disconnected (%s)", e)
+                        self._remove(client)
@@ -1,6 +1,9 @@
+from . import calibration
 from . import config_params
 from . import thermometer
 from . import harddrive
+from . import sysfs
+from . import timing
 from . import util
 
 import collections
@@ -9,6 +12,10 @@ import time
 
 logger = logging.getLogger(__name__)
 
+thermometer_classes = [thermometer.SystemThermometer,
+                       harddrive.Harddrive,
+                       thermometer.MockThermometer]
+
 class Fan(config_params.Configurable):
     _params = [
         ("name", None, "Name that will appear in status output."),
@@ -18,14 +25,23 @@ class Fan(config_params.Configurable):
         ("min_settle_time", 30, "Minimal number of seconds at minimum pwm before stopping the fan."),
         ("max_settle_time", 12 * 60 * 60, "Maximal number of seconds at minimum pwm before stopping the fan."),
         ("pid", config_params.InstanceOf([util.Pid], Exception), "PID controller for this fan."),
-        ("thermometers", config_params.ListOf([thermometer.SystemThermometer,
-                                               harddrive.Harddrive,
-                                               thermometer.MockThermometer]), ""),
+        ("feed_forward", config_params.InstanceOf([util.FeedForward], {}), "Feed forward from thermometer activity."),
+        ("calibration", config_params.InstanceOf([calibration.Calibration], {}),
+         "Measurement of minimal PWM and of the PWM to RPM curve."),
+        ("thermometers", config_params.ListOf(thermometer_classes, "_find_shared_thermometer"),
+         "Thermometers of this fan. Besides thermometer definitions this can contain names "
+         "of thermometers shared on the controler level."),
+        ("max_reading_age", 120, "If a thermometer of this fan doesn't have a fresh reading for longer than "
+                                 "this (seconds), it is considered degraded and the fan runs at safe_pwm."),
+        ("safe_pwm", 255, "PWM used while some thermometer is degraded."),
         ("fan_max_rpm_sanity_check", 0, "Fan speed larger than this value are considered as a glitch reading and ignored. Value of 0 means to not check the range."),
     ]
 
     def __init__(self, parent, params):
+        self._shared_thermometers = {t.name: t for t in getattr(parent, "thermometers", [])}
+        self._timings = getattr(parent, "timings", timing.no_timings)
         self.process_params(params)
+        self._check_thermometers()
 
         self._state = "running"
         self._spinup_timer = util.TimeoutHelper(self.spinup_time)
@@ -34,14 +50,147 @@ class Fan(config_params.Configurable):
         self._min_pwm_helper = _MinPowerHelper(self.min_pwm, 1, parent.min_rpm_probe_interval)
 
         self._last_pwm = None
-        self.set_pwm_checked(255)
+        self._curve = None
 
         self._last_rpm = 0
+        self._spinup_age = None # Time since the spinup that didn't reach nonzero speed yet
+        self._watched_time = 0 # Time covered by watch steps since the last update
+        self._last_spinup_time = None
+        self._reading_ages = {} # thermometer -> time since its last fresh reading
 
+    def _check_thermometers(self):
         duplicate_thermometer_names = util.duplicates(thermometer.name for thermometer in self.thermometers)
         if duplicate_thermometer_names:
             raise ValueError("Duplicate thermometer names: {}".format(", ".join(duplicate_thermometer_names)))
 
+    def reload_params(self, parent, params):
+        old_own_thermometers = list(self._own_thermometers())
+        self._shared_thermometers = {t.name: t for t in getattr(parent, "thermometers", [])}
+        super().reload_params(parent, params)
+
+        for t in old_own_thermometers:
+            if t not in self.thermometers:
+                t.close()
+
+    def params_reloaded(self, parent, old_values):
+        self._check_thermometers()
+
+        self._spinup_timer.limit = self.spinup_time
+        self._settle_timer.limit = util.clamp(self._settle_timer.limit, self.min_settle_time, self.max_settle_time)
+        self._min_pwm_helper.set_probe_interval(parent.min_rpm_probe_interval)
+
+        if old_values["thermometers"] != self.thermometers:
+            # Derivatives and activity models are per thermometer
+            self.pid.reset_derivatives()
+            self.feed_forward.reset()
+            self._reading_ages = {t: age for t, age in self._reading_ages.items() if t in self.thermometers}
+
+    def _find_shared_thermometer(self, name):
+        try:
+            return self._shared_thermometers[name]
+        except KeyError:
+            raise RuntimeError("Unknown shared thermometer " + name) from None
+
+    def _own_thermometers(self):
+        """ Iterate over thermometers of this fan that are not shared with other fans. """
+        for t in self.thermometers:
+            if self._shared_thermometers.get(t.name) is not t:
+                yield t
+
+    def alarm_paths(self):
+        """ Return list of hwmon alarm attributes of this fan and its thermometers. """
+        paths = []
+        for t in self.thermometers:
+            paths.extend(t.alarm_paths())
+        return paths
+
+    def is_calibrated(self):
+        return self._curve is not None
+
+    def calibrate(self, sleep = time.sleep):
+        """ Measure the stall and start thresholds and the PWM to RPM curve.
+        Thermometers of the fan are read whenever the calibration waits, if any of them
+        exceeds its target temperature, the calibration is aborted with RuntimeError.
+        The fan is left at full power. """
+        def wait(seconds):
+            sleep(seconds)
+            self._check_calibration_temperatures(seconds)
+
+        try:
+            curve = self.calibration.run(self, wait)
+        finally:
+            self._last_pwm = None
+            self.set_pwm_checked(255)
+        self._apply_curve(curve)
+        return curve
+
+    def _check_calibration_temperatures(self, dt):
+        for t in self.thermometers:
+            t.update(dt)
+            temperature = t.get_cached_temperature()
+            if temperature is not None and temperature > t.target_temperature:
+                raise RuntimeError("{} exceeded target temperature during calibration of {}".format(t.name,
+                                                                                                   self.name))
+
+    def _apply_curve(self, curve):
+        self._curve = curve
+        self._min_pwm_helper.calibrated(min(curve.stall_pwm + self.calibration.margin, 255))
+
+    def _spinup_pwm(self):
+        if self._curve is None:
+            return self.spinup_pwm
+        return min(self._curve.start_pwm + self.calibration.margin, 255)
+
+    def get_state(self):
+        """ Return the learned state as a JSON serializable dict. """
+        return {"min_pwm": self._min_pwm_helper.get_state(),
+                "curve": None if self._curve is None else self._curve.get_state(),
+                "settle_timeout": self._settle_timer.limit,
+                "inputs": [t.name for t in self.thermometers],
+                "pid": self.pid.get_state(),
+                "thermometers": {t.name: t.get_state() for t in self._own_thermometers()}}
+
+    def restore_state(self, state, age):
+        """ Restore state returned by get_state saved age seconds ago,
+        return dict of the restored values.
+        Raises KeyError, TypeError or ValueError if the state is not valid. """
+        # Everything is validated first, so that an invalid state doesn't get partially restored
+        settle_timeout = util.clamp(util.finite_float(state["settle_timeout"]),
+                                    self.min_settle_time, self.max_settle_time)
+
+        # Derivatives are only useful if the inputs match and the smoothing didn't forget them yet
+        restore_derivatives = state["inputs"] == [t.name for t in self.thermometers] and \
+                              age < self.pid.derivative_smoothing
+        apply_pid, restored_pid = self.pid.prepare_restore_state(state["pid"], len(self.thermometers),
+                                                                 restore_derivatives)
+        apply_min_pwm, restored_min_pwm = self._min_pwm_helper.prepare_restore_state(state["min_pwm"])
+        curve = None
+        if state.get("curve") is not None:
+            curve = calibration.FanCurve.from_state(state["curve"])
+
+        thermometer_states = state["thermometers"]
+        prepared_thermometers = [(t.name, t.prepare_restore_state(thermometer_states[t.name], age))
+                                 for t in self._own_thermometers()
+                                 if t.name in thermometer_states]
+
+        apply_pid()
+        apply_min_pwm()
+        restored = {"pid": restored_pid, "min_pwm": restored_min_pwm}
+        if curve is not None:
+            self._curve = curve
+            restored["curve"] = curve.get_state()
+        self._settle_timer.limit = settle_timeout
+        self._settle_timer.reset()
+        restored["settle_timeout"] = settle_timeout
+
+        restored["thermometers"] = {}
+        for name, (apply_thermometer, restored_thermometer) in prepared_thermometers:
+            apply_thermometer()
+            if restored_thermometer is not None:
+                restored["thermometers"][name] = restored_thermometer
+
+        return restored
+
     def get_rpm(self):
         """ Read rpm of the fan. Needs to be overridden. """
         raise NotImplementedError()
@@ -59,7 +208,8 @@ class Fan(config_params.Configurable):
             return
 
         logger.debug("Setting {} to {}".format(self.name, self._pwm_to_percent(pwm)))
-        self.set_pwm(pwm)
+        with self._timings.measure("fans", self.name, "pwm_write"):
+            self.set_pwm(pwm)
         self._last_pwm = pwm
 
     @staticmethod
@@ -71,34 +221,140 @@ class Fan(config_params.Configurable):
         self._state = state
         logger.debug("Changing state of {} to {}".format(self.name, state))
 
-    def update(self, dt):
-        """ This is where the internal state machine is implemented """
+    def _readings_missing(self):
+        """ Return True if some thermometer of this fan doesn't have a temperature yet. """
+        return any(t.get_cached_temperature() is None for t in self.thermometers)
+
+    def watching(self):
+        """ Return True if speed of the fan should be watched between updates. """
+        return self._state in ("spinup", "settle") or self._spinup_age is not None
+
+    def watch(self, dt):
+        """ Read speed of the fan between updates, without touching the thermometers.
+        dt is the time since the previous update or watch.
+        Returns True if the fan stopped when it should be spinning and needs an update right away. """
+        self._watched_time += dt
+        self._advance_spinup_age(dt)
+        with self._timings.measure("fans", self.name, "rpm_read"):
+            rpm = self.get_rpm()
+        self._check_spinup(rpm)
+        return rpm == 0 and (self._state in ("running", "settle") or self._spinup_failed())
+
+    def _spinup_failed(self):
+        """ Return True if the fan is in spinup, but it stopped again after reaching nonzero speed
+        or it didn't reach it in spinup_time. Only meaningful when the speed reads zero. """
+        if self._state != "spinup":
+            return False
+        return self._spinup_age is None or self._spinup_age > self.spinup_time
+
+    def _advance_spinup_age(self, dt):
+        if self._spinup_age is not None:
+            self._spinup_age += dt
+
+    def _check_spinup(self, rpm):
+        """ Record time from the start of spinup to the first nonzero speed reading. """
+        if self._spinup_age is None or rpm == 0:
+            return
+        self._last_spinup_time = self._spinup_age
+        self._spinup_age = None
+        self._timings.record(self._last_spinup_time, "fans", self.name, "spinup")
+        logger.debug("%s reached %d rpm %.1fs after spinup", self.name, rpm, self._last_spinup_time)
+
+    def start(self, dt):
+        """ Choose the initial PWM from the first readings of the thermometers
+        (and state restored before) instead of starting at full power.
+        dt is the time step used for the initial PID update. """
+        if self._readings_missing():
+            logger.warning("Some thermometers of %s don't have a reading yet, starting at full power", self.name)
+            self.set_pwm_checked(255)
+            return
+
+        errors = [t.get_normalized_temperature_error() for t in self.thermometers]
+        pwm, _ = self.pid.update(errors, dt)
+        pwm = util.clamp(pwm, self._min_pwm_helper.value, 255)
+
+        if self.get_rpm() == 0:
+            self._spinup(pwm)
+        else:
+            self.set_pwm_checked(pwm)
+        logger.info("Starting %s at %s", self.name, self._pwm_to_percent(self._last_pwm))
+
+    def update(self, dt, thermometers_status):
+        """ This is where the internal state machine is implemented.
+        thermometers_status is a dict thermometer -> status block containing
+        the already updated thermometers of this fan. """
         new_dt = float("inf")
         status_block = {}
 
-        rpm = self.get_rpm()
+        # Watch steps since the last update already advanced the spinup age by their part of dt
+        self._advance_spinup_age(max(dt - self._watched_time, 0))
+        self._watched_time = 0
+
+        with self._timings.measure("fans", self.name, "rpm_read"):
+            rpm = self.get_rpm()
         if self.fan_max_rpm_sanity_check != 0 and rpm > self.fan_max_rpm_sanity_check:
             logger.warning("Detected glitch speed reading of {} ({}), using last value of {} instead.",
                            self.name, rpm, self._last_rpm)
             rpm = self._last_rpm
         else:
             logger.debug("Speed of {} is {} rpm".format(self.name, rpm))
+        self._check_spinup(rpm)
 
         status_block["rpm"] = rpm
+        if self._last_spinup_time is not None:
+            status_block["spinup_time"] = self._last_spinup_time
 
-        thermometers_status = {}
+        status_block["thermometers"] = {}
+        degraded = []
         for thermometer in self.thermometers:
-            thermometers_status[thermometer.name] = thermometer.update(dt)
-        status_block["thermometers"] = thermometers_status
+            thermometer_status = thermometers_status[thermometer]
+            if thermometer_status.get("stale"):
+                age = self._reading_ages.get(thermometer, 0) + dt
+                thermometer_status = dict(thermometer_status, reading_age=age)
+                if age > self.max_reading_age:
+                    thermometer_status["degraded"] = True
+                    degraded.append(thermometer.name)
+            else:
+                age = 0
+            self._reading_ages[thermometer] = age
+            status_block["thermometers"][thermometer.name] = thermometer_status
+        status_block["degraded"] = degraded
+
+        if self._readings_missing():
+            logger.warning("Some thermometers of %s don't have a reading yet, using full power", self.name)
+            self.set_pwm_checked(255)
+            status_block["pwm"] = self._last_pwm
+            return new_dt, status_block
+
+        if degraded:
+            logger.warning("Readings of %s are too old, setting %s to %s",
+                           ", ".join(degraded), self.name, self._pwm_to_percent(self.safe_pwm))
+            if self._state == "stopped" or rpm == 0:
+                self._spinup(self.safe_pwm)
+            else:
+                self.set_pwm_checked(self.safe_pwm)
+                self._change_state("running")
+            status_block["pwm"] = self._last_pwm
+            return new_dt, status_block
 
         errors = [t.get_normalized_temperature_error()
                   for t in self.thermometers]
         max_error = max(errors)
-        pwm, max_derivative = self.pid.update(errors, dt)
+        with self._timings.measure("fans", self.name, "pid_update"):
+            pwm, max_derivative = self.pid.update(errors, dt)
+
+        feed_forward = self.feed_forward.update([t.get_cached_activity() for t in self.thermometers],
+                                                self.pid.get_derivatives(), dt)
+        pwm += feed_forward
+
+        if self.calibration.linearize and self._curve is not None:
+            # Output is a fraction of the maximal speed
+            pwm = self._curve.pwm_for_rpm(self._curve.max_rpm * pwm / 255)
 
         clamped_pwm = clamped_pwm = util.clamp(pwm, self._min_pwm_helper.value, 255)
 
-        if rpm == 0 and self._state in ("running", "settle"):
+        if rpm == 0 and (self._state in ("running", "settle") or self._spinup_failed()):
+            self._spinup_age = None # New attempt gets the whole spinup_time again
             self._spinup(clamped_pwm)
             self._min_pwm_helper.failed()
             logger.info("%s not spinning when it should, increasing min PWM to %s",
@@ -111,7 +367,7 @@ class Fan(config_params.Configurable):
                     self._change_state("running")
                 else:
                     new_dt = min(new_dt, self._spinup_timer.remaining_time)
-                    clamped_pwm = max(clamped_pwm, self.spinup_pwm)
+                    clamped_pwm = max(clamped_pwm, self._spinup_pwm())
 
             self.set_pwm_checked(clamped_pwm)
 
@@ -149,14 +405,23 @@ class Fan(config_params.Configurable):
         else:
             raise Exception("Unknown state " + self._state)
 
-        status_block["pid"] = {"error": max_error, "derivative": 60*max_derivative, "integrator": self.pid._integrator/60} # Derivative is in degrees / minute, integrator in minutes
+        status_block["pid"] = {"error": max_error, "derivative": 60*max_derivative, "integrator": self.pid._integrator/60, # Derivative is in degrees / minute, integrator in minutes
+                               "predicted_error": self.pid.get_max_predicted_error()}
+        status_block["feed_forward"] = {"output": feed_forward,
+                                        "coefficients": dict(zip((t.name for t in self.thermometers),
+                                                                 self.feed_forward.get_coefficients()))}
+        status_block["pwm"] = self._last_pwm
         status_block["min_pwm"] = self._min_pwm_helper.value
         status_block["settle_timeout"] = self._settle_timer.limit
+        if self._curve is not None:
+            status_block["calibration"] = self._curve.get_state()
 
         return new_dt, status_block
 
     def _spinup(self, pwm):
-        self.set_pwm_checked(max(pwm, self.spinup_pwm))
+        if self._spinup_age is None:
+            self._spinup_age = 0
+        self.set_pwm_checked(max(pwm, self._spinup_pwm()))
         self._change_state("spinup")
         self._spinup_timer.reset()
 
@@ -168,18 +433,25 @@ class SystemFan(Fan, config_params.Configurable):
     ]
 
     def __init__(self, parent, params):
+        self._rpm_attribute = None
+        self._pwm_attribute = None
         super().__init__(parent, params)
 
         if not len(self.name):
             self.name = self.get_automatic_name()
 
+    def alarm_paths(self):
+        return sysfs.alarm_paths(self.rpm_path) + super().alarm_paths()
+
     def get_rpm(self):
-        with open(self.rpm_path, "r") as fp:
-            return int(fp.readline())
+        if self._rpm_attribute is None:
+            self._rpm_attribute = sysfs.Attribute(self.rpm_path)
+        return self._rpm_attribute.read_int()
 
     def set_pwm(self, value):
-        with open(self.pwm_path, "w") as fp:
-            print(str(value), file=fp)
+        if self._pwm_attribute is None:
+            self._pwm_attribute = sysfs.Attribute(self.pwm_path, writable=True)
+        self._pwm_attribute.write_int(value)
 
 
 class MockFan(Fan, config_params.Configurable):
@@ -214,6 +486,36 @@ class _MinPowerHelper:
         return self.value
 
     def failed(self):
-        self.value += self._step
+        self.value = min(self.value + self._step, 255)
         self._probing = False
         self._probe_timeout.reset()
+
+    def calibrated(self, value):
+        """ Use measured minimal value, probing only resumes after the probe interval. """
+        self.value = value
+        self._probing = False
+        self._probe_timeout.reset()
+
+    def set_probe_interval(self, probe_interval):
+        self._probe_timeout.limit = probe_interval
+        self._probe_timeout.remaining_time = min(self._probe_timeout.remaining_time, probe_interval)
+
+    def get_state(self):
+        return {"value": self.value,
+                "probing": self._probing,
+                "probe_timeout": self._probe_timeout.remaining_time}
+
+    def prepare_restore_state(self, state):
+        """ Validate state returned by get_state, return tuple of a function
+        that restores it and the restored minimal PWM. """
+        value = int(state["value"])
+        if not 0 < value <= 255:
+            raise ValueError("Minimal PWM {} out of range".format(value))
+        probe_timeout = util.clamp(util.finite_float(state["probe_timeout"]), 0, self._probe_timeout.limit)
+        probing = bool(state["probing"])
+
+        def apply():
+            self.value = value
+            self._probing = probing
+            self._probe_timeout.remaining_time = probe_timeout
+        return apply, value
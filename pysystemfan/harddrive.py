@@ -1,7 +1,11 @@
 from . import config_params
+from . import sgio
+from . import sysfs
 from . import thermometer
 from . import util
 
+import asyncio
+import json
 import subprocess
 import shlex
 import os
@@ -10,20 +14,81 @@ import logging
 
 logger = logging.getLogger(__name__)
 
-def _iterate_command_output(self, command):
-    process = subprocess.Popen(command,
-                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL,
-                               universal_newlines=True)
-    for line in process.stdout:
-        yield line
-
-    if process.wait():
+def _command_result(command, timeout):
+    """ Run command, return its return code and whole output (bytes).
+    The process gets killed if it doesn't finish in timeout seconds. """
+    try:
+        process = subprocess.run(command,
+                                 stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL,
+                                 timeout=timeout)
+    except subprocess.TimeoutExpired:
+        raise RuntimeError("Command {} didn't finish in {}s".format(_list_to_shell(command), timeout)) from None
+    return process.returncode, process.stdout
+
+async def _command_result_async(command, timeout):
+    """ Asyncio version of _command_result.
+    The process also gets killed if the waiting is cancelled. """
+    process = await asyncio.create_subprocess_exec(*command,
+                                                   stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.DEVNULL,
+                                                   stdin=asyncio.subprocess.DEVNULL)
+    try:
+        stdout, _ = await asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise RuntimeError("Command {} didn't finish in {}s".format(_list_to_shell(command), timeout)) from None
+    except asyncio.CancelledError:
+        process.kill()
+        raise
+
+    return process.returncode, stdout
+
+def _check_output(command, returncode, stdout):
+    if returncode:
         raise RuntimeError("Command {} failed with return code {}".format(_list_to_shell(command),
-                                                                          process.returncode))
+                                                                          returncode))
+    return stdout.decode(errors="replace").splitlines()
+
+def _command_output(command, timeout):
+    """ Run command, return list of lines of its output. Raises RuntimeError if it fails. """
+    return _check_output(command, *_command_result(command, timeout))
+
+async def _command_output_async(command, timeout):
+    """ Asyncio version of _command_output. """
+    return _check_output(command, *await _command_result_async(command, timeout))
 
 def _list_to_shell(l):
     return " ".join(shlex.quote(x) for x in l)
 
+# Return code that smartctl -n standby,N uses when the drive is in low power mode.
+# Bits 0 and 1 of the return code mean that the command failed, higher bits only report
+# drive health problems and the output is still valid.
+_smartctl_standby_status = 3
+_smartctl_failure_mask = 0x03
+
+def _json_temperature(data):
+    """ Find current temperature in smartctl JSON output, None if there is none.
+    Works with ATA, SCSI and NVMe devices. """
+    try:
+        return int(data["temperature"]["current"])
+    except (KeyError, TypeError, ValueError):
+        pass
+
+    try:
+        return int(data["nvme_smart_health_information_log"]["temperature"])
+    except (KeyError, TypeError, ValueError):
+        pass
+
+    for attribute in data.get("ata_smart_attributes", {}).get("table", []):
+        if attribute.get("id") in (194, 190): # Temperature_Celsius, Airflow_Temperature_Cel
+            try:
+                return int(attribute["raw"]["value"]) & 0xff # Higher bytes may contain min/max
+            except (KeyError, TypeError, ValueError):
+                pass
+
+    return None
+
 class Harddrive(thermometer.Thermometer, config_params.Configurable):
     _params = [
         ("path", None, "Device file of the disk. For example /dev/sda"),
@@ -36,23 +101,115 @@ class Harddrive(thermometer.Thermometer, config_params.Configurable):
                              "This value will be rounded to the nearest update interval, "
                              "if zero, the drive will not be spun down by this sctipt."),
         ("measure_in_idle", False, "Selects whether to keep measuring temperature even when the drive is idle."),
+        ("power_state_verify_interval", 0, "If nonzero, whether the drive is spinning is inferred from its I/O "
+                                           "(which spins it up) and from spindowns done by this script, and the drive "
+                                           "only gets queried when this many seconds passed without either of them. "
+                                           "Only use this if nothing else spins the drive down (e.g. its own "
+                                           "standby timer). Zero (the default) queries the drive in every update."),
+        ("command_timeout", 30, "Commands (smartctl, hdparm, SG_IO requests) that take longer than this (seconds) "
+                                "are killed and the reading fails."),
+        ("backend", "subprocess", "How to query the drive. \"subprocess\" runs smartctl and hdparm, "
+                                  "\"smartctl_json\" runs a single smartctl with JSON output that skips drives "
+                                  "in standby (needs smartctl 7.0 or newer, works with SCSI and NVMe drives too), "
+                                  "\"sgio\" sends ATA commands directly through SG_IO ioctl on a device file kept open "
+                                  "and falls back to subprocess if that fails."),
     ]
 
     def __init__(self, parent, params):
         self.process_params(params)
-        if not len(self.stat_path):
-            self.stat_path = "/sys/block/{}/stat".format(os.path.basename(self.path))
-
-        self._previous_stat = None
+        self._setup_stat()
         self._spindown_timeout = util.TimeoutHelper(self.spindown_time)
+        self._setup_power_state()
+        self._setup_backend()
 
         self._cached_temperature = None
         self._cached_spinning = None
         self._cached_iops = None
 
+    def params_reloaded(self, parent, old_values):
+        if not len(self.stat_path):
+            self.stat_path = self._default_stat_path()
+        if self.stat_path != old_values["stat_path"]:
+            self._stat_attribute.close()
+            self._setup_stat()
+        if self.spindown_time != old_values["spindown_time"]:
+            self._spindown_timeout = util.TimeoutHelper(self.spindown_time)
+        if self.power_state_verify_interval != old_values["power_state_verify_interval"]:
+            self._setup_power_state()
+        if self.path != old_values["path"] or self.backend != old_values["backend"]:
+            self._close_ata_device()
+            self._setup_backend()
+        elif self._ata_device is not None:
+            self._ata_device.timeout = self.command_timeout
+
+    def _default_stat_path(self):
+        return "/sys/block/{}/stat".format(os.path.basename(self.path))
+
+    def _setup_stat(self):
+        if not len(self.stat_path):
+            self.stat_path = self._default_stat_path()
+        self._stat_attribute = sysfs.Attribute(self.stat_path)
+        self._previous_stat = None
+
+    def _setup_power_state(self):
+        if self.power_state_verify_interval > 0:
+            self._power_state = _PowerStateTracker(self.power_state_verify_interval)
+        else:
+            self._power_state = None
+
+    def _setup_backend(self):
+        self._ata_device = None
+        if self.backend == "sgio":
+            try:
+                self._ata_device = sgio.AtaDevice(self.path, self.command_timeout)
+            except OSError as e:
+                logger.warning("Can't open %s for SG_IO, falling back to subprocess (%s)", self.path, e)
+        elif self.backend not in ("subprocess", "smartctl_json"):
+            raise ValueError("Unknown harddrive backend " + self.backend)
+
+    def _close_ata_device(self):
+        if self._ata_device is not None:
+            self._ata_device.close()
+            self._ata_device = None
+
+    def close(self):
+        self._close_ata_device()
+        self._stat_attribute.close()
+
+    def _sgio_fallback(self, e):
+        logger.warning("SG_IO query of %s failed, falling back to subprocess (%s)", self.path, e)
+        self._close_ata_device()
+
+    @staticmethod
+    async def _ata_device_call_async(function):
+        """ Run blocking SG_IO query in the default executor, so that it doesn't stall the event loop. """
+        return await asyncio.get_running_loop().run_in_executor(None, function)
+
     def get_temperature(self):
-        command = ["smartctl", "-A", self.path]
-        for line in _iterate_command_output(self, command):
+        if self._ata_device is not None:
+            try:
+                return self._ata_device.get_temperature()
+            except (OSError, RuntimeError) as e:
+                self._sgio_fallback(e)
+
+        command = self._temperature_command()
+        return self._parse_temperature(_command_output(command, self.command_timeout), command)
+
+    async def get_temperature_async(self):
+        if self._ata_device is not None:
+            try:
+                return await self._ata_device_call_async(self._ata_device.get_temperature)
+            except (OSError, RuntimeError) as e:
+                self._sgio_fallback(e)
+
+        command = self._temperature_command()
+        return self._parse_temperature(await _command_output_async(command, self.command_timeout), command)
+
+    def _temperature_command(self):
+        return ["smartctl", "-A", self.path]
+
+    def _parse_temperature(self, lines, command):
+        for line in lines:
             split = line.split()
             if len(split) < 10:
                 continue
@@ -68,14 +225,65 @@ class Harddrive(thermometer.Thermometer, config_params.Configurable):
 
         raise RuntimeError("Didn't find temperature in output of {}".format(_list_to_shell(command)))
 
+    def _smartctl_json_command(self, standby_mode):
+        return ["smartctl", "--json", "-n", standby_mode, "-A", self.path]
+
+    def _parse_smartctl_json(self, returncode, output, command):
+        """ Return temperature, is_spinning tuple from result of the smartctl JSON command.
+        Temperature is None if the drive is in standby. """
+        if returncode == _smartctl_standby_status:
+            return None, False
+        elif returncode & _smartctl_failure_mask:
+            raise RuntimeError("Command {} failed with return code {}".format(_list_to_shell(command),
+                                                                              returncode))
+
+        try:
+            temperature = _json_temperature(json.loads(output.decode(errors="replace")))
+        except ValueError as e:
+            raise RuntimeError("Can't parse output of {} ({})".format(_list_to_shell(command), e)) from e
+
+        if temperature is None:
+            raise RuntimeError("Didn't find temperature in output of {}".format(_list_to_shell(command)))
+
+        return temperature, True
+
     def spindown(self):
         logger.info("Spinning down hard drive %s", self.name)
-        subprocess.check_call(["hdparm", "-y", self.path],
-                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        _command_output(["hdparm", "-y", self.path], self.command_timeout)
+        if self._power_state is not None:
+            self._power_state.spun_down()
+
+    async def spindown_async(self):
+        logger.info("Spinning down hard drive %s", self.name)
+        await _command_output_async(["hdparm", "-y", self.path], self.command_timeout)
+        if self._power_state is not None:
+            self._power_state.spun_down()
 
     def is_spinning(self):
-        command = ["hdparm", "-C", self.path]
-        for line in _iterate_command_output(self, command):
+        if self._ata_device is not None:
+            try:
+                return self._ata_device.is_spinning()
+            except (OSError, RuntimeError) as e:
+                self._sgio_fallback(e)
+
+        command = self._drive_state_command()
+        return self._parse_drive_state(_command_output(command, self.command_timeout), command)
+
+    async def is_spinning_async(self):
+        if self._ata_device is not None:
+            try:
+                return await self._ata_device_call_async(self._ata_device.is_spinning)
+            except (OSError, RuntimeError) as e:
+                self._sgio_fallback(e)
+
+        command = self._drive_state_command()
+        return self._parse_drive_state(await _command_output_async(command, self.command_timeout), command)
+
+    def _drive_state_command(self):
+        return ["hdparm", "-C", self.path]
+
+    def _parse_drive_state(self, lines, command):
+        for line in lines:
             split = line.split(":")
             if len(split) >= 2 and split[0].strip() == "drive state is":
                 state = split[1].strip()
@@ -89,8 +297,7 @@ class Harddrive(thermometer.Thermometer, config_params.Configurable):
         raise RuntimeError("Didn't find drive state in output of {}".format(_list_to_shell(command)))
 
     def _get_stat(self):
-        with open(self.stat_path, "r") as fp:
-            return tuple(map(int, fp.read().split()))
+        return self._stat_attribute.read_ints()
 
     def _get_io(self):
         stat = self._get_stat()
@@ -107,12 +314,47 @@ class Harddrive(thermometer.Thermometer, config_params.Configurable):
     def get_cached_temperature(self):
         return self._cached_temperature
 
+    def get_state(self):
+        if self.spindown_time <= 0:
+            return None
+        return {"spindown_timeout": self._spindown_timeout.remaining_time}
+
+    def prepare_restore_state(self, state, age):
+        if self.spindown_time <= 0 or state is None:
+            return super().prepare_restore_state(state, age)
+        remaining_time = util.clamp(util.finite_float(state["spindown_timeout"]), 0, self.spindown_time)
+
+        def apply():
+            self._spindown_timeout.remaining_time = remaining_time
+        return apply, {"spindown_timeout": remaining_time}
+
     def get_cached_activity(self):
         return (int(self._cached_spinning), self._cached_iops)
 
-    def _get_temp_safe(self):
+    def _tracked_power_state(self, dt, had_io):
+        """ Return whether the drive is spinning if it is known without querying the drive, otherwise None. """
+        if self._power_state is None:
+            return None
+        return self._power_state.update(dt, had_io)
+
+    def _verified_power_state(self, is_spinning):
+        if self._power_state is not None:
+            self._power_state.verified(is_spinning)
+        return is_spinning
+
+    def _get_temp_safe(self, dt, had_io):
         """ Return temperature, is_spinning tuple."""
-        is_spinning = self.is_spinning()
+        if self.backend == "smartctl_json":
+            command = self._smartctl_json_command("standby,{}".format(_smartctl_standby_status))
+            temperature, is_spinning = self._parse_smartctl_json(*_command_result(command, self.command_timeout), command)
+            if temperature is None and self.measure_in_idle:
+                command = self._smartctl_json_command("never")
+                temperature, _ = self._parse_smartctl_json(*_command_result(command, self.command_timeout), command)
+            return temperature, is_spinning
+
+        is_spinning = self._tracked_power_state(dt, had_io)
+        if is_spinning is None:
+            is_spinning = self._verified_power_state(self.is_spinning())
 
         if is_spinning or self.measure_in_idle:
             temperature = self.get_temperature()
@@ -121,27 +363,66 @@ class Harddrive(thermometer.Thermometer, config_params.Configurable):
 
         return temperature, is_spinning
 
+    async def _get_temp_safe_async(self, dt, had_io):
+        if self.backend == "smartctl_json":
+            command = self._smartctl_json_command("standby,{}".format(_smartctl_standby_status))
+            temperature, is_spinning = self._parse_smartctl_json(*await _command_result_async(command, self.command_timeout), command)
+            if temperature is None and self.measure_in_idle:
+                command = self._smartctl_json_command("never")
+                temperature, _ = self._parse_smartctl_json(*await _command_result_async(command, self.command_timeout), command)
+            return temperature, is_spinning
+
+        is_spinning = self._tracked_power_state(dt, had_io)
+        if is_spinning is None:
+            is_spinning = self._verified_power_state(await self.is_spinning_async())
+
+        if is_spinning or self.measure_in_idle:
+            temperature = await self.get_temperature_async()
+        else:
+            temperature = None
+
+        return temperature, is_spinning
+
     def init(self):
-        temperature, is_spinning = self._get_temp_safe()
         self._previous_stat = self._get_stat()
+        temperature, is_spinning = self._get_temp_safe(0, False)
+        self._cached_iops = 0
+        return self._store(temperature, is_spinning)
 
-        self._cached_temperature = temperature
-        self._cached_spinning = is_spinning
+    async def init_async(self):
+        self._previous_stat = self._get_stat()
+        temperature, is_spinning = await self._get_temp_safe_async(0, False)
         self._cached_iops = 0
+        return self._store(temperature, is_spinning)
 
     def update(self, dt):
-        temperature, is_spinning = self._get_temp_safe()
         had_io, ops = self._get_io()
+        temperature, is_spinning = self._get_temp_safe(dt, had_io)
+        if self._process_io(dt, had_io, ops, is_spinning):
+            self.spindown()
+        return self._store(temperature, is_spinning)
+
+    async def update_async(self, dt):
+        had_io, ops = self._get_io()
+        temperature, is_spinning = await self._get_temp_safe_async(dt, had_io)
+        if self._process_io(dt, had_io, ops, is_spinning):
+            await self.spindown_async()
+        return self._store(temperature, is_spinning)
+
+    def _process_io(self, dt, had_io, ops, is_spinning):
+        """ Update iops and spindown timer, return True if the drive should be spun down. """
+        self._cached_iops = ops / dt
 
         if is_spinning and self.spindown_time > 0:
             if had_io:
                 self._spindown_timeout.reset()
             elif self._spindown_timeout(dt):
-                self.spindown()
+                return True
+        return False
 
+    def _store(self, temperature, is_spinning):
         self._cached_temperature = temperature
         self._cached_spinning = is_spinning
-        self._cached_iops = ops / dt
 
         logger.debug("Harddrive {} {}°C (target {}°C), {:.1g} iops{}".format(self.name,
                                                                              self._cached_temperature,
@@ -153,3 +434,31 @@ class Harddrive(thermometer.Thermometer, config_params.Configurable):
                 "target_temperature": self.target_temperature,
                 "iops": self._cached_iops,
                 "spinning": self._cached_spinning}
+
+
+class _PowerStateTracker:
+    """ Helper that keeps track of whether a drive is spinning without querying it.
+    Any I/O spins the drive up and after our own spindown it stays in standby
+    until the next I/O. The state is unknown at start and after verify_interval
+    without I/O or verification. """
+
+    def __init__(self, verify_interval):
+        self._verify_timeout = util.TimeoutHelper(verify_interval)
+        self._state = None
+
+    def update(self, dt, had_io):
+        """ Return the inferred state, or None if the drive needs to be queried. """
+        if self._state is None:
+            return None
+        if had_io:
+            self.verified(True)
+        elif self._verify_timeout(dt):
+            return None
+        return self._state
+
+    def verified(self, is_spinning):
+        self._state = is_spinning
+        self._verify_timeout.reset()
+
+    def spun_down(self):
+        self.verified(False)
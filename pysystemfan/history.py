@@ -0,0 +1,159 @@
+import array
+import math
+import threading
+
+_nan = float("nan")
+
+class _Level:
+    """ One resolution level of the history, a ring buffer with float32 array per metric
+    and each stored value being (min, max, mean) of the aggregated samples. """
+
+    def __init__(self, length):
+        self.length = length
+        self.count = 0 # Total number of samples ever appended
+        self.times = array.array("d", [0]) * length
+        self.series = {} # name -> (min array, max array, mean array)
+
+    def oldest(self):
+        """ Logical index of the oldest sample still stored """
+        return max(0, self.count - self.length)
+
+    def time(self, i):
+        return self.times[i % self.length]
+
+    def get(self, name, i):
+        minimum, maximum, mean = self.series[name]
+        i %= self.length
+        return minimum[i], maximum[i], mean[i]
+
+    def bisect(self, t):
+        """ Return logical index of the first sample with time >= t. """
+        lo = self.oldest()
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.time(mid) < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def append(self, timestamp, values):
+        """ Append one sample, values is a dict name -> (min, max, mean). """
+        index = self.count % self.length
+        self.times[index] = timestamp
+
+        for name in values:
+            if name not in self.series:
+                self.series[name] = tuple(array.array("f", [_nan]) * self.length for i in range(3))
+
+        for name, arrays in self.series.items():
+            value = values.get(name)
+            if value is None:
+                value = (_nan, _nan, _nan)
+            for a, v in zip(arrays, value):
+                a[index] = v
+
+        self.count += 1
+
+class _Accumulator:
+    """ Collects samples from a finer level until a bucket of a coarser level is complete. """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.n = 0
+        self.timestamp = None
+        self.values = {} # name -> [min, max, sum, count]
+
+    def add(self, timestamp, values):
+        if self.timestamp is None:
+            self.timestamp = timestamp
+        self.n += 1
+        for name, (minimum, maximum, mean) in values.items():
+            if math.isnan(mean):
+                continue
+            accumulated = self.values.get(name)
+            if accumulated is None:
+                self.values[name] = [minimum, maximum, mean, 1]
+            else:
+                accumulated[0] = min(accumulated[0], minimum)
+                accumulated[1] = max(accumulated[1], maximum)
+                accumulated[2] += mean
+                accumulated[3] += 1
+
+    def result(self):
+        return {name: (minimum, maximum, total / count)
+                for name, (minimum, maximum, total, count) in self.values.items()}
+
+class History:
+    """ In-memory time series of named metrics with fixed memory usage.
+
+    Samples are kept in several resolution levels, each level aggregates `factor`
+    samples of the previous one into (min, max, mean) and keeps `length` of them.
+    Queries pick the level that has a reasonable number of samples in the requested
+    range, so long ranges never scan the full resolution data. """
+
+    def __init__(self, length, levels, factor=16):
+        self._factor = factor
+        self._levels = [_Level(length) for i in range(levels)]
+        self._accumulators = [_Accumulator() for i in range(levels - 1)]
+        self._lock = threading.Lock()
+
+    def record(self, timestamp, values):
+        """ Record one sample, values is a dict name -> number (or None if not available). """
+        values = {name: (_nan, _nan, _nan) if value is None else (value, value, value)
+                  for name, value in values.items()}
+        with self._lock:
+            self._levels[0].append(timestamp, values)
+            for level, accumulator in zip(self._levels[1:], self._accumulators):
+                accumulator.add(timestamp, values)
+                if accumulator.n < self._factor:
+                    break
+                timestamp = accumulator.timestamp
+                values = accumulator.result()
+                accumulator.reset()
+                level.append(timestamp, values)
+
+    def query(self, start, end, max_points, prefix=""):
+        """ Return samples between start and end (unix timestamps) downsampled to at most
+        max_points buckets, as a JSON serializable dict. Only metrics whose names start
+        with prefix are returned. """
+        max_points = max(max_points, 1)
+        with self._lock:
+            for level_number, level in enumerate(self._levels):
+                lo = level.bisect(start)
+                hi = level.bisect(end)
+                covers_start = level.count <= level.length or level.time(level.oldest()) <= start
+                if covers_start and hi - lo <= max_points * self._factor:
+                    break
+
+            bucket_size = max(1, math.ceil((hi - lo) / max_points))
+            names = sorted(name for name in level.series if name.startswith(prefix))
+
+            times = []
+            metrics = {name: {"min": [], "max": [], "mean": []} for name in names}
+            for bucket_start in range(lo, hi, bucket_size):
+                bucket_end = min(bucket_start + bucket_size, hi)
+                times.append(level.time(bucket_start))
+
+                for name in names:
+                    accumulator = _Accumulator()
+                    for i in range(bucket_start, bucket_end):
+                        accumulator.add(None, {name: level.get(name, i)})
+                    result = accumulator.result().get(name)
+                    output = metrics[name]
+                    if result is None:
+                        output["min"].append(None)
+                        output["max"].append(None)
+                        output["mean"].append(None)
+                    else:
+                        output["min"].append(result[0])
+                        output["max"].append(result[1])
+                        output["mean"].append(result[2])
+
+        return {"level": level_number,
+                "bucket_samples": bucket_size * self._factor**level_number,
+                "time": times,
+                "metrics": metrics}
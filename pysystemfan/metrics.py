@@ -0,0 +1,120 @@
+from . import timing
+
+# (metric name, path of keys in the status block, help)
+_fan_gauges = [
+    ("pysystemfan_fan_rpm", ("rpm",), "Fan speed in RPM."),
+    ("pysystemfan_fan_pwm", ("pwm",), "PWM value set to the fan (0-255)."),
+    ("pysystemfan_fan_min_pwm", ("min_pwm",), "Currently learned minimal PWM value."),
+    ("pysystemfan_fan_spinup_seconds", ("spinup_time",), "Time from the last spinup to the first nonzero speed reading."),
+    ("pysystemfan_fan_settle_timeout_seconds", ("settle_timeout",), "Time spent at minimal PWM before stopping the fan."),
+    ("pysystemfan_fan_pid_error", ("pid", "error"), "Maximal normalized temperature error."),
+    ("pysystemfan_fan_pid_derivative", ("pid", "derivative"), "Derivative of the temperature error (per minute)."),
+    ("pysystemfan_fan_pid_integrator", ("pid", "integrator"), "Integrator of the PID controller (minutes)."),
+]
+
+_thermometer_gauges = [
+    ("pysystemfan_thermometer_temperature_celsius", ("temperature",), "Measured temperature."),
+    ("pysystemfan_thermometer_target_temperature_celsius", ("target_temperature",), "Target temperature."),
+    ("pysystemfan_thermometer_iops", ("iops",), "Harddrive operations per second."),
+    ("pysystemfan_thermometer_spinning", ("spinning",), "1 if the harddrive is spinning."),
+    ("pysystemfan_thermometer_reading_age_seconds", ("reading_age",), "Time since the last successful reading, "
+                                                                      "only present while readings fail."),
+]
+
+_duration_histogram = "pysystemfan_operation_duration_seconds"
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _get(block, keys):
+    for key in keys:
+        if not isinstance(block, dict):
+            return None
+        block = block.get(key)
+    return block
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    return repr(float(value))
+
+class MetricsRenderer:
+    """ Renders status snapshot in the Prometheus text exposition format.
+
+    Label strings are built once per fan and thermometer and reused,
+    so rendering cost only depends on the number of values. """
+
+    def __init__(self):
+        self._fan_labels = {} # fan name -> label string
+        self._thermometer_labels = {} # (fan name, thermometer name) -> label string
+        self._timing_labels = {} # timing key -> label string without braces
+
+    def _labels_for_fan(self, fan_name):
+        labels = self._fan_labels.get(fan_name)
+        if labels is None:
+            labels = '{{fan="{}"}}'.format(_escape(fan_name))
+            self._fan_labels[fan_name] = labels
+        return labels
+
+    def _labels_for_thermometer(self, fan_name, thermometer_name):
+        key = (fan_name, thermometer_name)
+        labels = self._thermometer_labels.get(key)
+        if labels is None:
+            labels = '{{fan="{}",thermometer="{}"}}'.format(_escape(fan_name), _escape(thermometer_name))
+            self._thermometer_labels[key] = labels
+        return labels
+
+    def _labels_for_timing(self, key):
+        labels = self._timing_labels.get(key)
+        if labels is None:
+            names = ("group", "name", "operation") if len(key) == 3 else ("group", "operation")
+            labels = ",".join('{}="{}"'.format(label, _escape(value)) for label, value in zip(names, key))
+            self._timing_labels[key] = labels
+        return labels
+
+    def _render_histograms(self, lines, timings):
+        """ Append duration histograms, timings is a list of (key, RollingStats). """
+        lines.append("# HELP {} Duration of sensor reads, fan accesses and status updates.".format(_duration_histogram))
+        lines.append("# TYPE {} histogram".format(_duration_histogram))
+        bounds = [repr(float(bound)) for bound in timing.histogram_buckets] + ["+Inf"]
+        for key, stats in timings:
+            labels = self._labels_for_timing(key)
+            cumulative = 0
+            for bound, count in zip(bounds, stats.bucket_counts):
+                cumulative += count
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(_duration_histogram, labels, bound, cumulative))
+            lines.append("{}_sum{{{}}} {}".format(_duration_histogram, labels, repr(float(stats.sum))))
+            lines.append("{}_count{{{}}} {}".format(_duration_histogram, labels, stats.count))
+
+    @staticmethod
+    def _render_family(lines, name, help_text, samples):
+        """ Append one metric family, samples is an iterable of (labels, value). """
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} gauge".format(name))
+        for labels, value in samples:
+            if value is not None:
+                lines.append(name + labels + " " + _format_value(value))
+
+    def render(self, data, timings = None):
+        """ Return the metrics text for the status data as bytes.
+        If timings (list of (key, RollingStats)) is given, duration histograms are added. """
+        fans = data.get("fans", {})
+        lines = []
+
+        for name, keys, help_text in _fan_gauges:
+            self._render_family(lines, name, help_text,
+                                ((self._labels_for_fan(fan_name), _get(fan_status, keys))
+                                 for fan_name, fan_status in fans.items()))
+
+        for name, keys, help_text in _thermometer_gauges:
+            self._render_family(lines, name, help_text,
+                                ((self._labels_for_thermometer(fan_name, thermometer_name),
+                                  _get(thermometer_status, keys))
+                                 for fan_name, fan_status in fans.items()
+                                 for thermometer_name, thermometer_status in fan_status.get("thermometers", {}).items()))
+
+        if timings is not None:
+            self._render_histograms(lines, timings)
+
+        lines.append("")
+        return "\n".join(lines).encode("utf-8")
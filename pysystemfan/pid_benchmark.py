@@ -0,0 +1,48 @@
+""" Compare speed of the PID backends.
+
+Run as `python3 -m pysystemfan.pid_benchmark`. """
+
+from . import util
+
+import argparse
+import random
+import time
+
+def _make_pid(backend):
+    return util.Pid(None, {"kP": 25, "kI": 0.05, "kD": 500, "backend": backend})
+
+def benchmark(backend, input_count, iterations):
+    """ Return average time of one Pid.update call in seconds. """
+    pid = _make_pid(backend)
+    errors = [random.uniform(-10, 1) for i in range(input_count)]
+    pid.update(errors, 15)
+
+    # Inputs are generated up front, so that only the updates are timed
+    error_vectors = []
+    for iteration in range(iterations):
+        errors = [e + random.uniform(-0.1, 0.1) for e in errors]
+        error_vectors.append(errors)
+
+    start = time.perf_counter()
+    for errors in error_vectors:
+        pid.update(errors, 15)
+    return (time.perf_counter() - start) / iterations
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark PID backends.")
+    parser.add_argument("--iterations", "-n", type=int, default=1000)
+    args = parser.parse_args()
+
+    backends = ["python"]
+    if util.numpy is not None:
+        backends.append("numpy")
+    else:
+        print("numpy is not installed, only benchmarking the python backend")
+
+    print("{:>8} ".format("inputs") + " ".join("{:>12}".format(backend) for backend in backends))
+    for input_count in (10, 100, 1000):
+        results = (benchmark(backend, input_count, args.iterations) for backend in backends)
+        print("{:>8} ".format(input_count) + " ".join("{:>10.2f}us".format(1e6 * t) for t in results))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+""" Minimal ATA access through the Linux SG_IO ioctl.
+
+Only what is needed for reading drive temperature and power state is implemented.
+The ioctl function is a parameter of AtaDevice, so that everything can be
+exercised without real disks. """
+
+import ctypes
+import fcntl
+import os
+import threading
+
+SG_IO = 0x2285
+SG_DXFER_NONE = -1
+SG_DXFER_FROM_DEV = -3
+
+_ATA_16 = 0x85
+_ATA_PROTOCOL_NON_DATA = 3
+_ATA_PROTOCOL_PIO_DATA_IN = 4
+
+_ATA_CHECK_POWER_MODE = 0xe5
+_ATA_SMART = 0xb0
+_SMART_READ_DATA = 0xd0
+
+_SECTOR_SIZE = 512
+_SENSE_SIZE = 32
+_DRIVER_SENSE = 0x08
+_CHECK_CONDITION = 0x02
+
+_ATA_STATUS_ERR = 0x01
+_ATA_STATUS_DF = 0x20
+
+_TEMPERATURE_ATTRIBUTES = (194, 190) # Temperature_Celsius, Airflow_Temperature_Cel
+
+class _SgIoHdr(ctypes.Structure):
+    _fields_ = [
+        ("interface_id", ctypes.c_int),
+        ("dxfer_direction", ctypes.c_int),
+        ("cmd_len", ctypes.c_ubyte),
+        ("mx_sb_len", ctypes.c_ubyte),
+        ("iovec_count", ctypes.c_ushort),
+        ("dxfer_len", ctypes.c_uint),
+        ("dxferp", ctypes.c_void_p),
+        ("cmdp", ctypes.c_void_p),
+        ("sbp", ctypes.c_void_p),
+        ("timeout", ctypes.c_uint),
+        ("flags", ctypes.c_uint),
+        ("pack_id", ctypes.c_int),
+        ("usr_ptr", ctypes.c_void_p),
+        ("status", ctypes.c_ubyte),
+        ("masked_status", ctypes.c_ubyte),
+        ("msg_status", ctypes.c_ubyte),
+        ("sb_len_wr", ctypes.c_ubyte),
+        ("host_status", ctypes.c_ushort),
+        ("driver_status", ctypes.c_ushort),
+        ("resid", ctypes.c_int),
+        ("duration", ctypes.c_uint),
+        ("info", ctypes.c_uint),
+    ]
+
+def ata_pass_through_16(protocol, command, features=0, sector_count=0,
+                        lba_mid=0, lba_high=0, data_in=False, check_condition=False):
+    """ Build ATA PASS-THROUGH (16) CDB for a 28bit ATA command. """
+    flags = 0
+    if check_condition:
+        flags |= 0x20
+    if data_in:
+        flags |= 0x08 | 0x04 | 0x02 # T_DIR = from device, BYT_BLOK = blocks, T_LENGTH = sector count
+
+    return bytes([_ATA_16,
+                  protocol << 1,
+                  flags,
+                  0, features,
+                  0, sector_count,
+                  0, 0, # LBA low
+                  0, lba_mid,
+                  0, lba_high,
+                  0, # Device
+                  command,
+                  0]) # Control
+
+def decode_power_mode(sense):
+    """ Extract sector count register of CHECK POWER MODE from sense data
+    and return True if the drive is spinning. """
+    response_code = sense[0] & 0x7f
+    if response_code == 0x72 and len(sense) >= 22 and sense[8] == 0x09:
+        count = sense[8 + 5] # ATA Status Return descriptor
+    elif response_code == 0x70 and len(sense) >= 7:
+        count = sense[6]
+    else:
+        raise RuntimeError("Unexpected sense data format 0x{:02x}".format(sense[0]))
+
+    # 0xff is what hdparm reports as "active/idle", everything else is some kind of
+    # standby or low power idle state.
+    return count == 0xff
+
+def decode_ata_status(sense):
+    """ Return tuple of ATA status and error registers from sense data,
+    or None if the sense data doesn't contain them. """
+    if not sense:
+        return None
+    response_code = sense[0] & 0x7f
+    if response_code == 0x72 and len(sense) >= 22 and sense[8] == 0x09:
+        return sense[8 + 13], sense[8 + 3] # ATA Status Return descriptor
+    elif response_code == 0x70 and len(sense) >= 14 and sense[12] == 0x00 and sense[13] == 0x1d:
+        return sense[4], sense[3] # ATA PASS-THROUGH INFORMATION AVAILABLE in the information field
+    return None
+
+def decode_smart_temperature(data):
+    """ Return temperature from SMART READ DATA buffer (512 bytes), or None if the
+    buffer doesn't contain any known temperature attribute. """
+    if len(data) < _SECTOR_SIZE:
+        raise ValueError("SMART data too short")
+
+    found = {}
+    for offset in range(2, 2 + 30 * 12, 12):
+        attribute_id = data[offset]
+        if attribute_id in _TEMPERATURE_ATTRIBUTES:
+            found[attribute_id] = data[offset + 5] # Lowest byte of the raw value
+
+    for attribute_id in _TEMPERATURE_ATTRIBUTES:
+        if attribute_id in found:
+            return found[attribute_id]
+    return None
+
+class AtaDevice:
+    """ Device file kept open for repeated ATA commands.
+    Commands that don't finish in timeout seconds are aborted by the kernel.
+    Commands can be sent from any thread, they are serialized because they share buffers. """
+
+    def __init__(self, path, timeout, ioctl=fcntl.ioctl, open_function=os.open):
+        self.path = path
+        self.timeout = timeout
+        self._ioctl = ioctl
+        self._fd = open_function(path, os.O_RDONLY | os.O_NONBLOCK)
+
+        self._data = ctypes.create_string_buffer(_SECTOR_SIZE)
+        self._sense = ctypes.create_string_buffer(_SENSE_SIZE)
+        self._lock = threading.Lock()
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _command(self, cdb, data_in):
+        cdb_buffer = ctypes.create_string_buffer(cdb, len(cdb))
+        ctypes.memset(self._sense, 0, _SENSE_SIZE)
+        ctypes.memset(self._data, 0, _SECTOR_SIZE) # Failed command must not leave the previous data behind
+
+        hdr = _SgIoHdr()
+        hdr.interface_id = ord("S")
+        hdr.cmd_len = len(cdb)
+        hdr.cmdp = ctypes.cast(cdb_buffer, ctypes.c_void_p)
+        hdr.mx_sb_len = _SENSE_SIZE
+        hdr.sbp = ctypes.cast(self._sense, ctypes.c_void_p)
+        hdr.timeout = max(int(self.timeout * 1000), 1) # Zero would mean the default timeout
+        if data_in:
+            hdr.dxfer_direction = SG_DXFER_FROM_DEV
+            hdr.dxfer_len = _SECTOR_SIZE
+            hdr.dxferp = ctypes.cast(self._data, ctypes.c_void_p)
+        else:
+            hdr.dxfer_direction = SG_DXFER_NONE
+
+        self._ioctl(self._fd, SG_IO, hdr)
+
+        if hdr.host_status or (hdr.driver_status & 0x0f) not in (0, _DRIVER_SENSE):
+            raise OSError("SG_IO on {} failed (host status {}, driver status {})".format(self.path,
+                                                                                       hdr.host_status,
+                                                                                       hdr.driver_status))
+
+        sense = self._sense.raw[:hdr.sb_len_wr]
+        ata_status = decode_ata_status(sense)
+        # With check_condition the registers come back as CHECK CONDITION even on success
+        if hdr.status and (hdr.status != _CHECK_CONDITION or ata_status is None):
+            raise OSError("SG_IO on {} failed (SCSI status 0x{:02x}, sense {})".format(self.path,
+                                                                                     hdr.status,
+                                                                                     sense.hex()))
+        if ata_status is not None and ata_status[0] & (_ATA_STATUS_ERR | _ATA_STATUS_DF):
+            raise OSError("ATA command on {} failed (status 0x{:02x}, error 0x{:02x})".format(self.path,
+                                                                                            *ata_status))
+        return sense
+
+    def is_spinning(self):
+        with self._lock:
+            return self._is_spinning()
+
+    def _is_spinning(self):
+        sense = self._command(ata_pass_through_16(_ATA_PROTOCOL_NON_DATA, _ATA_CHECK_POWER_MODE,
+                                                  check_condition=True),
+                              data_in=False)
+        return decode_power_mode(sense)
+
+    def get_temperature(self):
+        with self._lock:
+            return self._get_temperature()
+
+    def _get_temperature(self):
+        self._command(ata_pass_through_16(_ATA_PROTOCOL_PIO_DATA_IN, _ATA_SMART,
+                                          features=_SMART_READ_DATA, sector_count=1,
+                                          lba_mid=0x4f, lba_high=0xc2, data_in=True),
+                      data_in=True)
+        temperature = decode_smart_temperature(self._data.raw)
+        if temperature is None:
+            raise RuntimeError("Didn't find temperature in SMART data of " + self.path)
+        return temperature
@@ -0,0 +1,238 @@
+""" Faster than real time simulation of the fan controller with a lumped thermal model.
+
+Run as `python3 -m pysystemfan.simulation simulation.json`. The config contains the
+simulation parameters, thermal bodies and fans (SimulatedFan, configured like a real fan)
+with SimulatedThermometers attached to the bodies. """
+
+from . import config_params
+from . import fan
+from . import thermometer
+
+import argparse
+import csv
+import json
+import logging
+import math
+
+logger = logging.getLogger(__name__)
+
+class ThermalBody(config_params.Configurable):
+    """ Lumped thermal mass, heated by a power source and cooled by passive
+    conduction to air and by airflow of a fan. """
+    _params = [
+        ("name", None, "Name used to attach thermometers to this body."),
+        ("heat_capacity", 1000, "Heat capacity in J/K."),
+        ("power", 10, "Constant dissipated power in W."),
+        ("burst_power", 0, "Additional power during bursts in W."),
+        ("burst_period", 24 * 60 * 60, "Time between starts of bursts in seconds."),
+        ("burst_duration", 0, "Duration of a burst in seconds."),
+        ("burst_start", 0, "Time of the first burst in seconds."),
+        ("passive_conductance", 0.2, "Thermal conductance to air without airflow in W/K."),
+        ("fan", "", "Name of the fan cooling this body."),
+        ("fan_conductance", 1, "Additional thermal conductance to air at full fan speed in W/K."),
+        ("initial_temperature", None, "Starting temperature. Defaults to the ambient temperature."),
+    ]
+
+    def __init__(self, parent, params):
+        params.setdefault("initial_temperature", parent.ambient_temperature)
+        self.process_params(params)
+        self.temperature = self.initial_temperature
+        self.current_power = self.power
+        self.fan_object = None
+
+    def get_power(self, t):
+        if self.burst_duration > 0 and t >= self.burst_start and \
+                (t - self.burst_start) % self.burst_period < self.burst_duration:
+            return self.power + self.burst_power
+        return self.power
+
+    def step(self, t, dt, ambient_temperature):
+        """ Advance the temperature by dt, using exact solution of the linear model
+        with power and airflow constant over the step. """
+        conductance = self.passive_conductance
+        if self.fan_object is not None:
+            conductance += self.fan_conductance * self.fan_object.airflow()
+
+        self.current_power = self.get_power(t)
+        equilibrium = ambient_temperature + self.current_power / conductance
+        decay = math.exp(-conductance * dt / self.heat_capacity)
+        self.temperature = equilibrium + (self.temperature - equilibrium) * decay
+
+class SimulatedThermometer(thermometer.MockThermometer, config_params.Configurable):
+    _params = [
+        ("body", None, "Name of the thermal body measured."),
+        ("resolution", 1, "Temperature reading gets rounded to this value (harddrives report whole degrees)."),
+    ]
+
+    def __init__(self, parent, params):
+        self.body_object = None
+        super().__init__(parent, params)
+
+    def update(self, dt):
+        if self.body_object is not None:
+            self.value = round(self.body_object.temperature / self.resolution) * self.resolution
+            self.activity1 = self.body_object.current_power
+        return super().update(dt)
+
+class SimulatedFan(fan.MockFan, config_params.Configurable):
+    """ Fan with a simple motor model: speed follows PWM with a time constant,
+    it stalls below stall_pwm and needs at least start_pwm to start. """
+    _params = [
+        ("thermometers", config_params.ListOf([SimulatedThermometer]), ""),
+        ("max_rpm", 1500, "Speed at full PWM."),
+        ("stall_pwm", 50, "Below this PWM the running fan stops."),
+        ("start_pwm", 90, "Minimal PWM that starts a stopped fan."),
+        ("rpm_time_constant", 2, "Time constant of speed changes in seconds."),
+        ("min_readable_rpm", 100, "Tachometer reads zero below this speed."),
+    ]
+
+    def __init__(self, parent, params):
+        self._pwm = 0
+        self._speed = 0
+        super().__init__(parent, params)
+
+    def start(self, dt):
+        self._speed = self.max_rpm # Start with the fan already running
+        super().start(dt)
+        self._speed = self.max_rpm * self._pwm / 255
+
+    def get_rpm(self):
+        if self._speed < self.min_readable_rpm:
+            return 0
+        return int(self._speed)
+
+    def set_pwm(self, value):
+        self._pwm = value
+
+    def airflow(self):
+        return self._speed / self.max_rpm
+
+    def step(self, dt):
+        if self._pwm < self.stall_pwm or (self._speed < self.min_readable_rpm and self._pwm < self.start_pwm):
+            target = 0
+        else:
+            target = self.max_rpm * self._pwm / 255
+        self._speed = target + (self._speed - target) * math.exp(-dt / self.rpm_time_constant)
+
+class _FanMetrics:
+    def __init__(self, fan):
+        self.fan = fan
+        self.starts = 0
+        self.stops = 0
+        self.stalls = 0
+        self.noise_integral = 0
+        self.time_above_target = {t.name: 0 for t in fan.thermometers}
+        self.max_temperature = {t.name: -float("inf") for t in fan.thermometers}
+        self._last_state = fan._state
+
+    def update(self, dt):
+        state = self.fan._state
+        if state != self._last_state:
+            if state == "spinup" and self._last_state == "stopped":
+                self.starts += 1
+            elif state == "spinup":
+                self.stalls += 1
+            elif state == "stopped":
+                self.stops += 1
+            self._last_state = state
+
+        self.noise_integral += (self.fan._last_pwm / 255)**4 * dt
+
+        for t in self.fan.thermometers:
+            temperature = t.get_cached_temperature()
+            if temperature > t.target_temperature:
+                self.time_above_target[t.name] += dt
+            self.max_temperature[t.name] = max(self.max_temperature[t.name], temperature)
+
+    def summary(self, duration):
+        return {"starts": self.starts,
+                "stops": self.stops,
+                "stalls": self.stalls,
+                "min_pwm": self.fan._min_pwm_helper.value,
+                "settle_timeout": self.fan._settle_timer.limit,
+                "noise_integral": self.noise_integral,
+                "mean_noise": self.noise_integral / duration,
+                "time_above_target": self.time_above_target,
+                "max_temperature": self.max_temperature}
+
+class Simulation(config_params.Configurable):
+    _params = [
+        ("duration", 30 * 24 * 60 * 60, "Simulated time in seconds."),
+        ("update_time", 30, "Time between controller updates in seconds."),
+        ("ambient_temperature", 25, "Air temperature."),
+        ("min_rpm_probe_interval", 30 * 24 * 60 * 60, "How often to try decreasing the minimum fan speed when one is already learned"),
+        ("trace_file", "", "CSV file to write trace of every update into. Empty means no trace."),
+        ("bodies", config_params.ListOf([ThermalBody]), ""),
+        ("fans", config_params.ListOf([SimulatedFan]), ""),
+    ]
+
+    def __init__(self, params):
+        self.process_params(params)
+
+        bodies = {body.name: body for body in self.bodies}
+        fans = {f.name: f for f in self.fans}
+        for body in self.bodies:
+            if len(body.fan):
+                body.fan_object = fans[body.fan]
+        for f in self.fans:
+            for t in f.thermometers:
+                t.body_object = bodies[t.body]
+                t.init()
+            f.start(self.update_time)
+
+    def run(self):
+        """ Run the whole simulation, return dict with summary metrics for each fan. """
+        metrics = [_FanMetrics(f) for f in self.fans]
+
+        trace_fp = None
+        if len(self.trace_file):
+            trace_fp = open(self.trace_file, "w", newline="")
+            trace = csv.writer(trace_fp)
+            header = ["time"]
+            for f in self.fans:
+                header.extend(f.name + "/" + column for column in ("state", "pwm", "rpm"))
+                header.extend(f.name + "/" + t.name for t in f.thermometers)
+            trace.writerow(header)
+
+        try:
+            t = 0
+            dt = self.update_time
+            while t < self.duration:
+                for body in self.bodies:
+                    body.step(t, dt, self.ambient_temperature)
+                for f in self.fans:
+                    f.step(dt)
+                t += dt
+
+                new_dt = self.update_time
+                row = [t]
+                for f, fan_metrics in zip(self.fans, metrics):
+                    thermometers_status = {thermometer: thermometer.update(dt) for thermometer in f.thermometers}
+                    fan_dt, status_block = f.update(dt, thermometers_status)
+                    new_dt = min(new_dt, fan_dt)
+                    fan_metrics.update(dt)
+                    row.extend([f._state, f._last_pwm, status_block["rpm"]])
+                    row.extend(thermometer.get_cached_temperature() for thermometer in f.thermometers)
+
+                if trace_fp is not None:
+                    trace.writerow(row)
+                dt = new_dt
+        finally:
+            if trace_fp is not None:
+                trace_fp.close()
+
+        return {fan_metrics.fan.name: fan_metrics.summary(self.duration) for fan_metrics in metrics}
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate the fan controller.")
+    parser.add_argument("config", help="simulation config file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    with open(args.config, "r") as fp:
+        simulation = Simulation(json.load(fp))
+    print(json.dumps(simulation.run(), indent=2))
+
+if __name__ == "__main__":
+    main()
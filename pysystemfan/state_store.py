@@ -0,0 +1,85 @@
+""" Persistent storage of the state learned by fans and thermometers. """
+
+from . import config_params
+from . import util
+
+import json
+import logging
+import os
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+_version = 1
+
+class StateStore(config_params.Configurable):
+    _params = [
+        ("path", "", "JSON file where the learned state is kept across restarts "
+                     "(for example /var/lib/pysystemfan/state.json). If empty (the default), nothing is stored."),
+        ("checkpoint_interval", 10 * 60, "Time between writes of the state file (seconds)."),
+        ("max_age", 7 * 24 * 60 * 60, "State older than this (seconds) is not restored."),
+    ]
+
+    def __init__(self, parent, params):
+        self.process_params(params)
+        self._checkpoint_timeout = util.TimeoutHelper(self.checkpoint_interval)
+
+    def params_reloaded(self, parent, old_values):
+        self._checkpoint_timeout = util.TimeoutHelper(self.checkpoint_interval)
+
+    def load(self):
+        """ Return tuple of stored state dict and its age in seconds,
+        or None if there is no usable state. """
+        if not len(self.path):
+            return None
+
+        try:
+            with open(self.path, "r") as fp:
+                data = json.load(fp)
+        except FileNotFoundError:
+            logger.info("No saved state in %s", self.path)
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning("Can't read saved state from %s (%s)", self.path, e)
+            return None
+
+        if not isinstance(data, dict) or data.get("version") != _version or \
+                not isinstance(data.get("time"), (int, float)) or not isinstance(data.get("state"), dict):
+            logger.warning("Ignoring saved state in %s with unknown format", self.path)
+            return None
+
+        age = time.time() - data["time"]
+        if age < 0 or age > self.max_age:
+            logger.warning("Ignoring saved state in %s, it is %.0fs old", self.path, age)
+            return None
+
+        return data["state"], age
+
+    def checkpoint_due(self, dt):
+        """ Return True if the state should be saved in this update. """
+        return len(self.path) > 0 and self._checkpoint_timeout(dt)
+
+    def save(self, state):
+        """ Atomically replace the state file with the given state.
+        Failures are only logged, the controler keeps running without persistence. """
+        if not len(self.path):
+            return
+
+        data = {"version": _version, "time": time.time(), "state": state}
+        directory = os.path.dirname(os.path.abspath(self.path))
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".pysystemfan-state-")
+            try:
+                with os.fdopen(fd, "w") as fp:
+                    json.dump(data, fp, indent=2)
+                    fp.flush()
+                    os.fsync(fp.fileno())
+                os.replace(temp_path, self.path)
+            except:
+                os.unlink(temp_path)
+                raise
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning("Can't save state to %s (%s)", self.path, e)
+        else:
+            logger.debug("Saved state to %s", self.path)
@@ -1,26 +1,70 @@
 from . import config_params
+from . import events
+from . import history
+from . import metrics
+from . import timing
 from . import util
 
+import asyncio
+import collections
+import gzip
+import hashlib
+import http
 import http.server
 import threading
+import time
 import json
 import logging
+import urllib.parse
 
 logger = logging.getLogger(__name__)
 
 _not_set = object()
 
+# Serialized status document, replaced as a whole on every update
+_Document = collections.namedtuple("_Document", ["body", "gzipped", "etag", "gzipped_etag"])
+
 class StatusServer(config_params.Configurable):
     _params = [
         ("port", _not_set, "Port where to serve the status page. Default is to not run a server."),
         ("bind", "127.0.0.1", "Address to bind to"),
-        ("status_path", "/status.json", "Path of the status file on the server")
+        ("status_path", "/status.json", "Path of the status file on the server"),
+        ("compress", True, "Keep a gzip compressed copy of the status document for clients that accept it."),
+        ("metrics_path", "/metrics", "Path of the metrics in Prometheus text format."),
+        ("events_path", "/events", "Path of the server-sent events stream. Clients get a full \"snapshot\" "
+                                   "event first and then a \"delta\" event (JSON merge patch) after every update."),
+        ("history_path", "/history", "Path of the history of temperatures and fan state. "
+                                     "Accepts query parameters from, to (unix timestamps, values <= 0 are "
+                                     "relative to now), points (maximal number of returned samples) "
+                                     "and prefix (only return metrics with names starting with this)."),
+        ("history_length", 2048, "Number of samples kept at each resolution level of the history. "
+                                 "Zero disables the history."),
+        ("history_levels", 3, "Number of resolution levels of the history, each one aggregates "
+                              "16 samples of the previous one."),
+        ("timing_histograms", False, "Add histograms of sensor, fan and status update latencies to the metrics."),
     ]
 
+    _restart_params = ("port", "bind", "history_length", "history_levels")
+
+    _async_timeout = 10 # Seconds to wait for a request in the asyncio server
+
     def __init__(self, parent, params):
         self.process_params(params)
+        self._timings = getattr(parent, "timings", timing.no_timings)
         self._data = {} # Storage for the exported data that are being processed (inactive yet)
         self._active_data = {} # Storage for the exported data that are being served
+        self._metrics_renderer = metrics.MetricsRenderer()
+        if self.port is not _not_set:
+            self._publish()
+
+        self._previous_data = {} # Shallow copy of the data sent in the last event
+        self._event_broadcaster = None # Event clients of the thread based server
+        self._async_event_clients = {} # Event clients of the asyncio server, writer -> needs snapshot
+
+        if self.history_length > 0 and self.port is not _not_set:
+            self._history = history.History(self.history_length, self.history_levels)
+        else:
+            self._history = None
 
     def __enter__(self):
         if self.port is not _not_set:
@@ -31,6 +75,15 @@ class StatusServer(config_params.Configurable):
         if self.port is not _not_set:
             self.stop()
 
+    async def __aenter__(self):
+        if self.port is not _not_set:
+            await self.start_async()
+        return self
+
+    async def __aexit__(self, *args):
+        if self.port is not _not_set:
+            await self.stop_async()
+
     def __getitem__(self, key):
         return self._data[key]
 
@@ -38,25 +91,169 @@ class StatusServer(config_params.Configurable):
         self._data[key] = value
 
     def update(self):
-        self._active_data = self._data
+        with self._timings.measure("status_server", "update"):
+            self._active_data = self._data
+            if self.port is _not_set:
+                return # Nobody can read the serialized forms
+            self._publish()
+            if self._history is not None:
+                self._history.record(time.time(), self._history_values())
+            self._publish_events()
+
+    def _has_event_clients(self):
+        return bool(self._async_event_clients) or \
+            (self._event_broadcaster is not None and self._event_broadcaster.client_count())
+
+    def _publish_events(self):
+        """ Push the new data to all event stream subscribers. """
+        previous = self._previous_data
+        current = dict(self._active_data) # Values are replaced, not modified, by the controler
+        self._previous_data = current
+
+        if not self._has_event_clients():
+            return
+
+        snapshot_frame = events.frame("snapshot", current)
+        delta_frame = events.frame("delta", events.merge_patch(previous, current))
+
+        if self._event_broadcaster is not None:
+            self._event_broadcaster.publish(snapshot_frame, delta_frame)
+
+        for writer, needs_snapshot in list(self._async_event_clients.items()):
+            if writer.transport.is_closing():
+                continue
+            if writer.transport.get_write_buffer_size():
+                # Slow client, drop this frame
+                self._async_event_clients[writer] = True
+            elif needs_snapshot:
+                writer.write(snapshot_frame)
+                self._async_event_clients[writer] = False
+            else:
+                writer.write(delta_frame)
+
+    def _history_values(self):
+        """ Flatten the fan status blocks into history metrics. """
+        values = {}
+        for fan_name, fan_status in self._active_data.get("fans", {}).items():
+            prefix = "fans/" + fan_name + "/"
+            values[prefix + "rpm"] = fan_status.get("rpm")
+            values[prefix + "pwm"] = fan_status.get("pwm")
+            values[prefix + "settle_timeout"] = fan_status.get("settle_timeout")
+            for key, value in fan_status.get("pid", {}).items():
+                values[prefix + "pid/" + key] = value
+            for thermometer_name, thermometer_status in fan_status.get("thermometers", {}).items():
+                values[prefix + "thermometers/" + thermometer_name + "/temperature"] = \
+                    thermometer_status.get("temperature")
+        return values
+
+    def _respond_history(self, query):
+        if self._history is None:
+            return 404, [], b""
+
+        try:
+            now = time.time()
+            start = float(query.get("from", ["0"])[0])
+            end = float(query.get("to", ["0"])[0])
+            points = int(query.get("points", ["500"])[0])
+        except ValueError:
+            return 400, [], b""
+        prefix = query.get("prefix", [""])[0]
+
+        if start <= 0:
+            start += now if start < 0 else float("-inf")
+        if end <= 0:
+            end += now
+
+        document = json.dumps(self._history.query(start, end, points, prefix)).encode("utf-8")
+        return 200, [("Content-type", "application/json")], document
+
+    def _publish(self):
+        """ Serialize the active data once, so that requests only send prepared bytes. """
+        body = json.dumps(self._active_data, indent=2).encode("utf-8")
+        digest = hashlib.sha1(body).hexdigest()
+        if self.compress:
+            gzipped = gzip.compress(body)
+        else:
+            gzipped = None
+        self._document = _Document(body, gzipped, '"{}"'.format(digest), '"{}-gzip"'.format(digest))
+        if self.timing_histograms:
+            self._metrics_document = self._metrics_renderer.render(self._active_data, self._timings.items())
+        else:
+            self._metrics_document = self._metrics_renderer.render(self._active_data)
+
+    @staticmethod
+    def _etag_matches(etag, request_headers):
+        if_none_match = request_headers.get("if-none-match")
+        if if_none_match is None:
+            return False
+        candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+        return "*" in candidates or etag in candidates
+
+    def _respond(self, path, request_headers):
+        """ Handle GET request, shared by both server implementations.
+        request_headers is a dict with lower case header names.
+        Returns (status code, list of (header, value) tuples, body). """
+        split_path = urllib.parse.urlsplit(path)
+        path = split_path.path
+
+        if path == self.history_path:
+            return self._respond_history(urllib.parse.parse_qs(split_path.query))
+        elif path == self.metrics_path:
+            return 200, [("Content-type", "text/plain; version=0.0.4; charset=utf-8")], self._metrics_document
+        elif path == self.status_path:
+            document = self._document # Local copy, update() may replace it any time
+
+            accept_encoding = request_headers.get("accept-encoding", "")
+            if document.gzipped is not None and "gzip" in accept_encoding:
+                body = document.gzipped
+                etag = document.gzipped_etag
+                headers = [("Content-encoding", "gzip")]
+            else:
+                body = document.body
+                etag = document.etag
+                headers = []
+            headers.extend([("ETag", etag), ("Vary", "Accept-Encoding")])
+
+            if self._etag_matches(etag, request_headers):
+                return 304, headers, b""
+
+            headers.append(("Content-type", "application/json"))
+            return 200, headers, body
+        else:
+            return 404, [], b""
 
     def start(self):
-        path = self.status_path
         instance = self # Local copy for handler
         address = (self.bind, self.port)
         class Handler(http.server.BaseHTTPRequestHandler):
             def do_GET(self):
                 try:
-                    if self.path == path:
-                        document = json.dumps(instance._active_data, indent=2).encode("utf-8")
-
+                    if urllib.parse.urlsplit(self.path).path == instance.events_path:
                         self.send_response(200)
-                        self.send_header("Content-type", "application/json")
-                        self.send_header("Content-length", len(document))
+                        for name, value in _event_stream_headers:
+                            self.send_header(name, value)
                         self.end_headers()
-                        self.wfile.write(document)
-                    else:
-                        self.send_error(404)
+                        self.wfile.flush()
+
+                        # The broadcaster takes over the connection
+                        self.server.detached_requests.add(self.request)
+                        instance._event_broadcaster.add_client(self.request.dup(),
+                                                               events.frame("snapshot", instance._previous_data))
+                        return
+
+                    request_headers = {name.lower(): value for name, value in self.headers.items()}
+                    code, headers, body = instance._respond(self.path, request_headers)
+                    if code in (400, 404):
+                        self.send_error(code)
+                        return
+
+                    self.send_response(code)
+                    for name, value in headers:
+                        self.send_header(name, value)
+                    if code != 304:
+                        self.send_header("Content-length", len(body))
+                    self.end_headers()
+                    self.wfile.write(body)
                 except Exception as e:
                     logger.exception("Exception in handler")
 
@@ -66,7 +263,10 @@ class StatusServer(config_params.Configurable):
             def log_message(self, msg, *args):
                 logger.debug("%s: " + msg, self.client_address[0], *args)
 
-        self._server = http.server.HTTPServer(address, Handler)
+        self._event_broadcaster = events.EventBroadcaster()
+        self._event_broadcaster.start()
+
+        self._server = _Server(address, Handler)
         self._thread = threading.Thread(target=self._server.serve_forever,
                                         name="Status HTTP")
 
@@ -77,4 +277,93 @@ class StatusServer(config_params.Configurable):
         logger.debug("Waiting for server to shut down")
         self._server.shutdown()
         self._thread.join()
+        self._event_broadcaster.stop()
+        logger.info("Server stopped")
+
+    async def start_async(self):
+        """ Start serving from the running event loop instead of a separate thread. """
+        address = (self.bind, self.port)
+        self._async_server = await asyncio.start_server(self._handle_async, self.bind, self.port)
+        logger.info("Starting asyncio server at %s", address)
+
+    async def stop_async(self):
+        self._async_server.close()
+        await self._async_server.wait_closed()
         logger.info("Server stopped")
+
+    async def _handle_async(self, reader, writer):
+        """ Minimal HTTP/1.0 handler for the asyncio server. """
+        client = writer.get_extra_info("peername")
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), self._async_timeout)
+            method, path, version = request_line.decode("latin-1").split()
+
+            request_headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), self._async_timeout)
+                if not line.strip():
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                request_headers[name.strip().lower()] = value.strip()
+
+            if method == "GET" and urllib.parse.urlsplit(path).path == self.events_path:
+                await self._stream_events_async(reader, writer)
+                return
+            elif method == "GET":
+                code, headers, body = self._respond(path, request_headers)
+            else:
+                code, headers, body = 501, [], b""
+            logger.debug("%s: \"%s\" %d", client[0], request_line.decode("latin-1").strip(), code)
+
+            response = ["HTTP/1.0 {} {}".format(code, http.HTTPStatus(code).phrase)]
+            response.extend("{}: {}".format(name, value) for name, value in headers)
+            if code != 304:
+                response.append("Content-length: {}".format(len(body)))
+            response.append("Connection: close")
+            writer.write(("\r\n".join(response) + "\r\n\r\n").encode("latin-1"))
+            writer.write(body)
+            await writer.drain()
+        except (ValueError, ConnectionError, asyncio.TimeoutError) as e:
+            logger.warning("%s: %s", client[0], e)
+        except Exception:
+            logger.exception("Exception in handler")
+        finally:
+            writer.close()
+
+    async def _stream_events_async(self, reader, writer):
+        response = ["HTTP/1.0 200 OK"]
+        response.extend("{}: {}".format(name, value) for name, value in _event_stream_headers)
+        writer.write(("\r\n".join(response) + "\r\n\r\n").encode("latin-1"))
+        writer.write(events.frame("snapshot", self._previous_data))
+
+        self._async_event_clients[writer] = False
+        try:
+            while True:
+                try:
+                    # Clients don't send anything, this only waits for the connection to close
+                    if not await asyncio.wait_for(reader.read(4096), events.keepalive_interval):
+                        break
+                except asyncio.TimeoutError:
+                    if not writer.transport.get_write_buffer_size():
+                        writer.write(events.keepalive_frame)
+        finally:
+            del self._async_event_clients[writer]
+
+_event_stream_headers = [("Content-type", "text/event-stream"),
+                         ("Cache-control", "no-cache")]
+
+class _Server(http.server.ThreadingHTTPServer):
+    """ Threading HTTP server that can hand connections over to someone else. """
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.detached_requests = set()
+
+    def shutdown_request(self, request):
+        if request in self.detached_requests:
+            # Only close our file descriptor, the connection lives on in a duplicate
+            self.detached_requests.discard(request)
+            self.close_request(request)
+        else:
+            super().shutdown_request(request)
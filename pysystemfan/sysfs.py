@@ -0,0 +1,73 @@
+import errno
+import os
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+# Errors that mean the file we hold open doesn't belong to a living device any more
+_REOPEN_ERRNOS = {errno.ENODEV, errno.ENOENT, errno.ENXIO, errno.ESTALE, errno.EBADF}
+
+_ALARM_SUFFIXES = ("_alarm", "_min_alarm", "_max_alarm", "_crit_alarm")
+
+def alarm_paths(input_path):
+    """ Return list of existing hwmon alarm attributes belonging to an input attribute,
+    for example temp1_alarm and temp1_crit_alarm for temp1_input. """
+    match = re.fullmatch(r"(.*/[a-z]+[0-9]+)_input", input_path)
+    if match is None:
+        return []
+    return [match.group(1) + suffix for suffix in _ALARM_SUFFIXES if os.path.exists(match.group(1) + suffix)]
+
+class Attribute:
+    """ Sysfs attribute file that is kept open and re-read from offset 0.
+
+    Reads go into a reused buffer, so a read costs a single pread syscall.
+    If the device disappears (for example after hwmon re-enumeration), the path is
+    opened again transparently. """
+
+    _buffer_size = 4096 # Sysfs attributes are at most one page long
+
+    def __init__(self, path, writable=False):
+        self.path = path
+        self._flags = (os.O_RDWR if writable else os.O_RDONLY) | os.O_CLOEXEC
+        self._fd = None
+        self._buffer = bytearray(self._buffer_size)
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _retry(self, function, *args):
+        """ Call function(fd, *args), reopening the file and retrying once
+        if it looks like the device was replaced. """
+        if self._fd is None:
+            self._fd = os.open(self.path, self._flags)
+            return function(self._fd, *args)
+
+        try:
+            return function(self._fd, *args)
+        except OSError as e:
+            if e.errno not in _REOPEN_ERRNOS:
+                raise
+            logger.info("Reopening %s (%s)", self.path, e)
+            self.close()
+            self._fd = os.open(self.path, self._flags)
+            return function(self._fd, *args)
+
+    def _read(self):
+        """ Return memoryview of the buffer with the attribute contents. """
+        length = self._retry(os.preadv, [self._buffer], 0)
+        return memoryview(self._buffer)[:length]
+
+    def read_int(self):
+        return int(self._read())
+
+    def read_ints(self):
+        return tuple(map(int, self._read().tobytes().split()))
+
+    def write_int(self, value):
+        self._retry(os.pwrite, b"%d" % value, 0)
@@ -1,4 +1,5 @@
 from . import config_params
+from . import sysfs
 
 import os
 import collections
@@ -11,14 +12,97 @@ class Thermometer(config_params.Configurable):
         ("name", "", "Name that will appear in status output."),
         ("target_temperature", None, "We're trying to keep temperature below this value."),
         ("temperature_scale", 1, "Temperature difference gets divided by this value before it is used for determining the fan speed."),
+        ("update_interval", 0, "Minimal time between readings of this thermometer (seconds). "
+                               "Zero (the default) means reading it in every update."),
+        ("max_update_interval", 0, "If larger than update_interval, the time between readings is adapted "
+                                   "between update_interval and this value, so that the temperature changes "
+                                   "by about one degree between readings."),
     ]
 
+    # Sampling state, shared by all subclasses regardless of how they initialize
+    _sample_age = 0 # Time since the last reading
+    _sample_interval = None # Current interval between readings, None until the first reading
+    _sampled_temperature = None # Temperature at the time of the last reading
+    _slope = 0 # Temperature change per second between the last two readings
+    _due_tolerance = 0.1 # Readings due in less than this many seconds are taken right away
+
     def __init__(self, parent, params):
         self.process_params(params)
-        self.update(None)
+
+    def close(self):
+        """ Release resources held by the thermometer when it is removed. """
+        pass
+
+    def alarm_paths(self):
+        """ Return list of hwmon alarm attributes that signal a problem with this thermometer. """
+        return []
+
+    def get_state(self):
+        """ Return learned state to persist across restarts as a JSON serializable value,
+        or None if there is nothing to persist. """
+        return None
+
+    def restore_state(self, state, age):
+        """ Restore state returned by get_state saved age seconds ago,
+        return dict of the restored values or None.
+        Raises KeyError, TypeError or ValueError if the state is not valid. """
+        apply, restored = self.prepare_restore_state(state, age)
+        apply()
+        return restored
+
+    def prepare_restore_state(self, state, age):
+        """ Validate state for restore_state without changing anything, return tuple
+        of a function that restores it and dict of the restored values or None.
+        Raises KeyError, TypeError or ValueError if the state is not valid. """
+        return (lambda: None), None
 
     def get_normalized_temperature_error(self):
-        return (self.get_cached_temperature() - self.target_temperature) / self.temperature_scale
+        return (self.get_estimated_temperature() - self.target_temperature) / self.temperature_scale
+
+    def is_due(self, dt):
+        """ Advance age of the last reading by dt and return True if the thermometer
+        should be read in this update. """
+        if dt is None or not self._sample_interval:
+            return True # First reading, or read in every update
+        self._sample_age += dt
+        return self.time_until_due() <= self._due_tolerance
+
+    def time_until_due(self):
+        """ Return time until the next reading is due, or infinity if this thermometer
+        is read in every update. """
+        if self._sample_interval is None or self._sample_interval <= 0:
+            return float("inf")
+        return max(self._sample_interval - self._sample_age, 0)
+
+    def sampled(self):
+        """ Called after every finished update, tracks temperature slope
+        for estimates between readings and adapts the reading interval. """
+        temperature = self.get_cached_temperature()
+
+        if temperature is not None and self._sampled_temperature is not None and self._sample_age > 0:
+            self._slope = (temperature - self._sampled_temperature) / self._sample_age
+        else:
+            self._slope = 0
+
+        if self.max_update_interval > self.update_interval:
+            if self._slope == 0:
+                interval = self.max_update_interval
+            else:
+                interval = 1 / abs(self._slope)
+            self._sample_interval = max(self.update_interval, min(interval, self.max_update_interval))
+        else:
+            self._sample_interval = self.update_interval
+
+        self._sampled_temperature = temperature
+        self._sample_age = 0
+
+    def get_estimated_temperature(self):
+        """ Return the cached temperature extrapolated to the current time.
+        Only rising temperatures are extrapolated, cooling is believed only once it is measured. """
+        temperature = self.get_cached_temperature()
+        if self._slope <= 0 or self._sample_interval is None:
+            return temperature
+        return temperature + self._slope * min(self._sample_age, self._sample_interval)
 
     def get_cached_temperature(self):
         """ Return temperature (in °C) measured by the thermometer during last update."""
@@ -35,19 +119,47 @@ class Thermometer(config_params.Configurable):
         dt is time since the last update. """
         raise NotImplementedError()
 
+    async def update_async(self, dt):
+        """ Asyncio version of update. Default implementation just calls update,
+        which is fine for thermometers that don't block. """
+        return self.update(dt)
+
+    def init(self):
+        """ Take the first reading, returns status block like update.
+        Called concurrently for all thermometers at startup. """
+        return self.update(None)
+
+    async def init_async(self):
+        """ Asyncio version of init. """
+        return await self.update_async(None)
+
 class SystemThermometer(Thermometer, config_params.Configurable):
     _params = [
         ("path", None, "Path in /sys (typically /sys/class/hwmon/hwmon?/temp?_input) that has the temperature."),
     ]
 
     def __init__(self, parent, params):
-        super().__init__(parent, params)
         self._cached_temperature = None
         self._cached_activity = None
+        self._attribute = None
+        super().__init__(parent, params)
+
+    def params_reloaded(self, parent, old_values):
+        if self.path != old_values["path"]:
+            self.close()
+
+    def close(self):
+        if self._attribute is not None:
+            self._attribute.close()
+            self._attribute = None
+
+    def alarm_paths(self):
+        return sysfs.alarm_paths(self.path)
 
     def get_temperature(self):
-        with open(self.path, "r") as fp:
-            return int(fp.readline()) / 1000
+        if self._attribute is None:
+            self._attribute = sysfs.Attribute(self.path)
+        return self._attribute.read_int() / 1000
 
     def get_cached_temperature(self):
         return self._cached_temperature
@@ -79,7 +191,7 @@ class MockThermometer(Thermometer, config_params.Configurable):
         return self.value
 
     def get_cached_activity(self):
-        return self.activity
+        return (self.activity1, self.activity2)
 
     def update(self, dt):
         return {"type": self.__class__.__name__,
@@ -0,0 +1,101 @@
+""" Latency measurements of the hot path operations. """
+
+import bisect
+import contextlib
+import threading
+import time
+
+# Upper bounds of histogram buckets in seconds, the last bucket is +Inf
+histogram_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class RollingStats:
+    """ Percentiles over the last window_size durations and a histogram of all of them,
+    both in fixed memory. """
+
+    def __init__(self, window_size):
+        self._window = [0.0] * window_size
+        self._position = 0
+        self.count = 0
+        self.sum = 0
+        self.bucket_counts = [0] * (len(histogram_buckets) + 1)
+
+    def record(self, duration):
+        self._window[self._position] = duration
+        self._position = (self._position + 1) % len(self._window)
+        self.count += 1
+        self.sum += duration
+        self.bucket_counts[bisect.bisect_left(histogram_buckets, duration)] += 1
+
+    def summary(self):
+        """ Return dict with count, p50, p95 and max of the window in seconds. """
+        values = sorted(self._window[:min(self.count, len(self._window))])
+        if not values:
+            return {"count": 0, "p50": None, "p95": None, "max": None}
+        last = len(values) - 1
+        return {"count": self.count,
+                "p50": values[round(0.5 * last)],
+                "p95": values[round(0.95 * last)],
+                "max": values[last]}
+
+class _Measurement:
+    def __init__(self, stats):
+        self._stats = stats
+
+    def __enter__(self):
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, *args):
+        self._stats.record(time.monotonic() - self._start)
+
+class Timings:
+    """ Collection of RollingStats, keyed by tuples like ("fans", fan name, operation).
+    Durations can be recorded from any thread. """
+
+    def __init__(self, window_size = 128):
+        self._window_size = window_size
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        try:
+            return self._stats[key]
+        except KeyError:
+            with self._lock:
+                return self._stats.setdefault(key, RollingStats(self._window_size))
+
+    def measure(self, *key):
+        """ Return context manager that records duration of its body under key. """
+        return _Measurement(self._get(key))
+
+    def record(self, duration, *key):
+        self._get(key).record(duration)
+
+    def items(self):
+        """ Return list of (key, RollingStats) pairs. """
+        with self._lock:
+            return list(self._stats.items())
+
+    def summary(self):
+        """ Return nested dict of summaries, one level per key item. """
+        ret = {}
+        for key, stats in self.items():
+            block = ret
+            for part in key[:-1]:
+                block = block.setdefault(part, {})
+            block[key[-1]] = stats.summary()
+        return ret
+
+class _NoTimings:
+    """ Stand-in for Timings for objects used outside of the controler. """
+
+    def measure(self, *key):
+        return contextlib.nullcontext()
+
+    def record(self, duration, *key):
+        pass
+
+    def items(self):
+        return []
+
+no_timings = _NoTimings()
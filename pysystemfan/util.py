@@ -1,10 +1,16 @@
 from . import config_params
 
-import itertools
+import asyncio
 import collections
+import math
 import time
 import logging
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 logger = logging.getLogger(__name__)
 
 def sleep_until(t):
@@ -14,9 +20,43 @@ def sleep_until(t):
     else:
         time.sleep(t - time.time())
 
+async def sleep_until_async(t):
+    time_to_sleep = t - time.time()
+    if time_to_sleep < 0:
+        logger.warn("Negative time to sleep (%fs)", time_to_sleep)
+    else:
+        await asyncio.sleep(t - time.time())
+
 def clamp(v, low, high):
     return max(low, min(v, high))
 
+def solve_linear(matrix, vector):
+    """ Solve a small system of linear equations using gaussian elimination.
+    Returns list of zeros if the system is singular. """
+    n = len(vector)
+    rows = [list(row) + [v] for row, v in zip(matrix, vector)]
+    for i in range(n):
+        pivot = max(range(i, n), key=lambda j: abs(rows[j][i]))
+        if rows[pivot][i] == 0:
+            return [0] * n
+        rows[i], rows[pivot] = rows[pivot], rows[i]
+        for j in range(i + 1, n):
+            factor = rows[j][i] / rows[i][i]
+            for k in range(i, n + 1):
+                rows[j][k] -= factor * rows[i][k]
+
+    solution = [0] * n
+    for i in reversed(range(n)):
+        solution[i] = (rows[i][n] - sum(rows[i][k] * solution[k] for k in range(i + 1, n))) / rows[i][i]
+    return solution
+
+def finite_float(value):
+    """ Convert value to float, raise ValueError if it is not a finite number. """
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError("{} is not a finite number".format(value))
+    return value
+
 def duplicates(iterable):
     seen = set()
     return set(x for x in iterable if ((x in seen) or seen.add(x)))
@@ -44,11 +84,24 @@ class Pid(config_params.Configurable):
         ("kD", 0, "Derivative constant"),
         ("derivative_smoothing", 120, "How many seconds has 50% influence on the result"),
         ("max_output", 255, "Maximum value of output due to the integral term (anti windup)"),
+        ("backend", "auto", "Implementation of the per input computations. "
+                            "\"python\", \"numpy\" or \"auto\" (numpy if it is installed)."),
     ]
 
     def __init__(self, parent, params):
         self.process_params(params)
+        self._setup()
+        self.reset()
+
+    def params_reloaded(self, parent, old_values):
+        use_numpy = self._use_numpy
+        self._setup()
+        self._integrator = clamp(self._integrator, 0, self._max_integrator)
+        if self._use_numpy != use_numpy:
+            self.reset_derivatives()
 
+    def _setup(self):
+        """ Compute values derived from the parameters. """
         if self.derivative_smoothing == 0:
             self._smoothing = 0
         else:
@@ -56,49 +109,96 @@ class Pid(config_params.Configurable):
 
         self._max_integrator = self.max_output / self.kI
 
-        self.reset()
+        if self.backend == "auto":
+            self._use_numpy = numpy is not None
+        elif self.backend == "numpy":
+            if numpy is None:
+                raise RuntimeError("Numpy PID backend requested, but numpy is not installed")
+            self._use_numpy = True
+        elif self.backend == "python":
+            self._use_numpy = False
+        else:
+            raise ValueError("Unknown PID backend " + self.backend)
 
     def reset(self):
         self._integrator = 0
+        self.reset_derivatives()
+
+    def reset_derivatives(self):
+        """ Forget derivatives, needed when the inputs change. """
         self._derivatives = None
         self._previous_errors = None
+        self._max_predicted_error = None
+
+    def get_derivatives(self):
+        """ Return smoothed derivatives of all inputs from the last update. """
+        return self._derivatives
+
+    def get_max_predicted_error(self):
+        """ Return the maximal error predicted one time step after the last update
+        (e + d * dt over all inputs). """
+        return self._max_predicted_error
 
     def reset_accumulator(self):
         self._integrator = 0
 
+    def get_state(self):
+        """ Return the learned state as a JSON serializable dict. """
+        state = {"integrator": self._integrator}
+        if self._derivatives is not None:
+            state["derivatives"] = [float(d) for d in self._derivatives]
+            state["previous_errors"] = [float(e) for e in self._previous_errors]
+        return state
+
+    def prepare_restore_state(self, state, input_count, restore_derivatives):
+        """ Validate state returned by get_state without changing anything, return tuple
+        of a function that restores it and dict of the restored values.
+        Raises KeyError, TypeError or ValueError if the state is not valid. """
+        integrator = clamp(finite_float(state["integrator"]), 0, self._max_integrator)
+        restored = {"integrator": integrator / 60} # In minutes, like in status
+
+        derivatives = None
+        if restore_derivatives and "derivatives" in state:
+            derivatives = [finite_float(d) for d in state["derivatives"]]
+            previous_errors = [finite_float(e) for e in state["previous_errors"]]
+            if len(derivatives) != input_count or len(previous_errors) != input_count:
+                raise ValueError("Number of PID inputs changed")
+            restored["derivative"] = 60 * max(derivatives)
+
+        def apply():
+            if derivatives is not None:
+                if self._use_numpy:
+                    self._derivatives = numpy.array(derivatives, dtype=float)
+                    self._previous_errors = numpy.array(previous_errors, dtype=float)
+                    self._scratch = numpy.empty(input_count)
+                else:
+                    self._derivatives = derivatives
+                    self._previous_errors = previous_errors
+            self._integrator = integrator
+
+        return apply, restored
+
     def update(self, errors, dt):
+        """ Update the controller with a new list of errors, one for each input.
+        Returns output and the maximal smoothed derivative of errors. """
         m = self._smoothing**dt # Multiplier for derivative smoothing
 
         if self._derivatives is not None:
             if len(errors) != len(self._derivatives):
                 raise ValueError("Changed number of errors")
+        elif self._use_numpy:
+            self._previous_errors = numpy.array(errors, dtype=float)
+            self._derivatives = numpy.zeros(len(errors))
+            self._scratch = numpy.empty(len(errors))
         else:
-            self._previous_errors = errors
-            self._derivatives = itertools.repeat(0)
-
-        max_next_predicted_error = None
-        selected_derivative = None # Selecting a derivative that would cause highest error in the next time step
-        new_derivatives = []
-        prev_max_error = -float("inf")
-        max_error = -float("inf")
-        max_derivative = 0;
-        for (e, p, d) in zip(errors, self._previous_errors, self._derivatives):
-            d = (1 - m) * d + m * (e - p) / dt # New smoothed derivative (using EWMA with variable time step)
-            new_derivatives.append(d)
-
-            if abs(d) > max_derivative:
-                max_derivative = d
-
-            next_predicted_error = e + d * dt # Predicted error after the next time step
-            if max_next_predicted_error is None or max_next_predicted_error < next_predicted_error:
-                max_next_predicted_error = next_predicted_error
-                selected_derivative = d
+            self._previous_errors = list(errors)
+            self._derivatives = [0] * len(errors)
 
-            prev_max_error = max(prev_max_error, p)
-            max_error = max(max_error, e)
-
-        self._previous_errors = errors
-        self._derivatives = new_derivatives
+        if self._use_numpy:
+            result = self._update_numpy(errors, dt, m)
+        else:
+            result = self._update_python(errors, dt, m)
+        max_error, prev_max_error, selected_derivative, max_derivative, self._max_predicted_error = result
 
         logger.debug("error = {:.2g}, derivative = {:.2g}, integrator = {:.2g}".format(max_error,
                                                                                 selected_derivative,
@@ -111,6 +211,147 @@ class Pid(config_params.Configurable):
 
         return ret, max_derivative
 
+    def _update_python(self, errors, dt, m):
+        """ Update the derivatives in place, return max error, previous max error,
+        selected derivative, max derivative and max predicted error. """
+        previous_errors = self._previous_errors
+        derivatives = self._derivatives
+        keep = 1 - m
+        rate = m / dt
+
+        max_next_predicted_error = -float("inf")
+        selected_derivative = 0 # Selecting a derivative that would cause highest error in the next time step
+        max_derivative = -float("inf")
+        for i, e in enumerate(errors):
+            d = keep * derivatives[i] + rate * (e - previous_errors[i]) # New smoothed derivative (using EWMA with variable time step)
+            derivatives[i] = d
+
+            if d > max_derivative:
+                max_derivative = d
+
+            next_predicted_error = e + d * dt # Predicted error after the next time step
+            if next_predicted_error > max_next_predicted_error:
+                max_next_predicted_error = next_predicted_error
+                selected_derivative = d
+
+        prev_max_error = max(previous_errors)
+        previous_errors[:] = errors
+
+        return max(errors), prev_max_error, selected_derivative, max_derivative, max_next_predicted_error
+
+    def _update_numpy(self, errors, dt, m):
+        """ Numpy version of _update_python, works in preallocated arrays. """
+        previous_errors = self._previous_errors
+        derivatives = self._derivatives
+        scratch = self._scratch
+        errors = numpy.asarray(errors, dtype=float)
+
+        numpy.subtract(errors, previous_errors, out=scratch)
+        scratch *= m / dt
+        derivatives *= 1 - m
+        derivatives += scratch
+
+        numpy.multiply(derivatives, dt, out=scratch)
+        scratch += errors # Predicted errors after the next time step
+        selected = scratch.argmax()
+        selected_derivative = float(derivatives[selected])
+        max_next_predicted_error = float(scratch[selected])
+
+        prev_max_error = float(previous_errors.max())
+        previous_errors[:] = errors
+
+        return (float(errors.max()), prev_max_error, selected_derivative, float(derivatives.max()),
+                max_next_predicted_error)
+
+class FeedForward(config_params.Configurable):
+    """ Immediate output contribution from thermometer activity.
+
+    Temperature keeps rising after an activity increase until it reaches a new equilibrium,
+    so the error derivative is modeled as proportional to the difference between current
+    activity and its low pass filtered value. For every thermometer the coefficients
+    are learned online by regression against the measured error derivative.
+    Activity changes show up immediately in the model output, before the temperature
+    starts to rise. """
+    _params = [
+        ("gain", 0, "Output per unit of predicted error derivative (similar to kD of the PID). "
+                    "Zero disables feed forward."),
+        ("time_constant", 600, "Half life (seconds) of the temperature response to an activity change."),
+        ("learning_time", 24 * 60 * 60, "How many seconds has 50% influence on the learned model."),
+        ("regularization", 1e-3, "Ridge regularization of the regression."),
+    ]
+
+    def __init__(self, parent, params):
+        self.process_params(params)
+        self.reset()
+
+    def reset(self):
+        self._models = None
+
+    def update(self, activities, derivatives, dt):
+        """ Learn from the current activities and error derivatives, return output contribution. """
+        if self.gain == 0:
+            return 0
+
+        if self._models is None:
+            self._models = [_ActivityModel(len(activity)) for activity in activities]
+        elif len(activities) != len(self._models):
+            raise ValueError("Changed number of activities")
+
+        max_predicted_derivative = 0
+        for model, activity, derivative in zip(self._models, activities, derivatives):
+            model.learn(activity, derivative, dt, self.time_constant, self.learning_time, self.regularization)
+            max_predicted_derivative = max(max_predicted_derivative, model.predict())
+
+        return self.gain * max_predicted_derivative
+
+    def get_coefficients(self):
+        """ Return list of learned regression coefficients for each input. """
+        if self._models is None:
+            return []
+        return [model.coefficients for model in self._models]
+
+class _ActivityModel:
+    """ Exponentially weighted linear regression of error derivative against
+    the difference between activity and its low pass filtered value. """
+
+    def __init__(self, n):
+        self.filtered = None
+        self.x = [0] * n
+        self.mean_x = [0] * n
+        self.mean_y = 0
+        self.cov_xx = [[0] * n for i in range(n)]
+        self.cov_xy = [0] * n
+        self.coefficients = [0] * n
+
+    def learn(self, activity, derivative, dt, time_constant, learning_time, regularization):
+        if self.filtered is None:
+            self.filtered = list(activity)
+            self.mean_y = derivative
+            return
+
+        a = 1 - 2**(-dt / time_constant)
+        self.filtered = [f + a * (x - f) for f, x in zip(self.filtered, activity)]
+        self.x = [x - f for x, f in zip(activity, self.filtered)]
+
+        w = 1 - 2**(-dt / learning_time)
+        n = len(self.x)
+        dx = [x - m for x, m in zip(self.x, self.mean_x)]
+        dy = derivative - self.mean_y
+        self.mean_x = [m + w * d for m, d in zip(self.mean_x, dx)]
+        self.mean_y += w * dy
+        for i in range(n):
+            for j in range(n):
+                self.cov_xx[i][j] = (1 - w) * (self.cov_xx[i][j] + w * dx[i] * dx[j])
+            self.cov_xy[i] = (1 - w) * (self.cov_xy[i] + w * dx[i] * dy)
+
+        regularized = [[c + (regularization if i == j else 0) for j, c in enumerate(row)]
+                       for i, row in enumerate(self.cov_xx)]
+        self.coefficients = solve_linear(regularized, self.cov_xy)
+
+    def predict(self):
+        """ Return error derivative predicted from the last learned activity. """
+        return sum(c * (x - m) for c, x, m in zip(self.coefficients, self.x, self.mean_x))
+
 class Interrupter:
     def __enter__(self):
         return self